@@ -19,9 +19,25 @@ ONEFILE = os.environ.get("CEFPYTHON_PYINSTALLER_ONEFILE", False)
 # Main
 # ----------------------------------------------------------------------------
 
+# Bundle plotly.js for offline use, from the repository root or the
+# plotly Python package if installed.
+data_files = []
+plotly_js = os.path.join("..", "plotly.min.js")
+if not os.path.isfile(plotly_js):
+    try:
+        import plotly
+        plotly_js = os.path.join(os.path.dirname(plotly.__file__), "package_data", "plotly.min.js")
+    except ImportError:
+        pass
+if os.path.isfile(plotly_js):
+    data_files.append((plotly_js, "."))
+else:
+    print("Warning: plotly.min.js not found, the app will load it from the CDN")
+
 a = Analysis(
     ["../meshviewer_plotly_cef_tk.py"],
     hookspath=["."],  # To find "hook-cefpython3.py"
+    datas=data_files,
     win_private_assemblies=True,
     win_no_prefer_redirects=True,
 )
@@ -0,0 +1,885 @@
+"""Shared Model/Mesh core of the STL/OBJ Python Mesh Viewer prototypes.
+
+The mesh data structures, file loaders and background loading used by
+the Matplotlib, Plotly/CEF and VisPy viewers, which only add their
+View and Controller classes. This module does not import any GUI
+backend and can be used on its own, for example for batch processing.
+
+:license: AGPL v3, see LICENSE for more details or contact
+          Precise Simulation for alternative licensing options.
+:copyright: 2020 Precise Simulation Ltd.
+
+"""
+
+import hashlib
+import re
+import glob
+import os
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    shared_memory = None
+
+import numpy as np
+
+# Binary STL triangle record (50 bytes): normal, 3 vertices, attribute.
+stl_binary_dtype = np.dtype([('normal', '<f4', (3,)),
+                             ('vertices', '<f4', (3, 3)),
+                             ('attr', '<u2')])
+
+
+class Model():
+
+    __slots__ = ('data', 'cache', 'mmap', 'weld', 'progress', '_bounds', '_bounds_data', '_bounding_box')
+
+    def __init__(self, file_name=None, mmap=False, weld=None, cache=None):
+
+        self.data = []
+        self.cache = cache
+        self.mmap = mmap
+        self.weld = weld
+        self.progress = None
+        # Stacked mesh bounds and their aggregate, see get_bounds.
+        self._bounds = np.empty((0, 3, 2))
+        self._bounds_data = []
+        self._bounding_box = None
+        if file_name is None:
+            # Define unit cube.
+            vertices = [[0,0,0], [1,0,0], [1,1,0], [0,1,0],
+                        [0,0,1], [1,0,1], [1,1,1], [0,1,1]]
+            faces = [[0,1,2], [0,2,3], [0,1,5], [0,5,4], [1,2,6], [1,6,5],
+                     [2,3,7], [2,7,6], [3,0,4], [3,4,7], [4,5,6], [4,6,7]]
+            data = Mesh(vertices, faces)
+
+            self.data = [data]
+        elif isinstance(file_name, (list, tuple)):
+            self.load_files(file_name, mmap=mmap, weld=weld)
+        else:
+            self.load_file(file_name, mmap, weld)
+
+    def clear(self):
+        self.data = []
+
+    def load_file(self, file_name, mmap=False, weld=None):
+        '''Load mesh from file
+
+        If weld is not None coincident vertices are merged after loading,
+        with weld as the tolerance (0 for exact matches). With a MeshCache
+        as self.cache, repeated loads of unchanged files are read from it.
+        The cache is skipped with mmap, as it would read the whole file
+        into memory.
+        '''
+        use_cache = self.cache is not None and not mmap
+        if use_cache:
+            mesh = self.cache.load(file_name, weld=weld)
+            if mesh is not None:
+                self.data.append(mesh)
+                return
+
+        n_data = len(self.data)
+        if file_name.lower().endswith(('.stl','.stla','.stlb')):
+            self.load_stl(file_name, mmap)
+
+        elif file_name.lower().endswith('.obj'):
+            self.load_obj(file_name)
+
+        if weld is not None or use_cache:
+            size = os.path.getsize(file_name)
+            n_faces = sum(len(mesh.faces) for mesh in self.data[n_data:])
+
+        if weld is not None:
+            for mesh in self.data[n_data:]:
+                mesh.weld(weld)
+            self.report_progress(size, size, n_faces)
+
+        if use_cache and len(self.data) == n_data + 1:
+            self.report_progress(size, size, n_faces)
+            self.cache.save(file_name, self.data[-1], weld=weld)
+
+    def load_stl(self, file_name, mmap=False):
+        '''Load STL CAD file
+        '''
+        if self.is_stl_binary(file_name):
+            self.load_stl_binary(file_name, mmap)
+            return
+
+        try:
+            self.load_stl_ascii(file_name)
+
+        except ValueError:
+            self.load_stl_binary(file_name, mmap)
+
+    def is_stl_binary(self, file_name):
+        '''Check if the file size matches the binary STL triangle count
+        '''
+        size = os.path.getsize(file_name)
+        if size < 84:
+            return False
+
+        with open(file_name, 'rb') as f:
+            f.seek(80)
+            n_tri = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+
+        return size == 84 + n_tri*stl_binary_dtype.itemsize
+
+    def load_stl_ascii(self, file_name, chunk_size=2**24):
+        '''Load ASCII STL CAD file
+
+        The file is streamed in chunks of chunk_size bytes and the vertex
+        coordinates collected in a preallocated buffer which grows
+        geometrically, keeping peak memory close to the final arrays.
+        '''
+        size = os.path.getsize(file_name)
+        # Initial guess of about 80 bytes of text per vertex.
+        vertices = np.empty((max(size//80, 1024), 3), dtype=np.float32)
+        n_vert = 0
+        tail = b''
+        with open(file_name, 'rb') as f:
+            line = f.readline()
+            line_data = line.split()
+            if not line_data or line_data[0] != b'solid':
+                raise ValueError('Not valid ASCII STL file.')
+
+            while True:
+                chunk = f.read(chunk_size)
+                if chunk:
+                    # Only parse complete lines, carry the rest over.
+                    i = chunk.rfind(b'\n')
+                    if i < 0:
+                        tail += chunk
+                        continue
+                    data, tail = tail + chunk[:i+1], chunk[i+1:]
+                else:
+                    data, tail = tail, b''
+
+                v = re.findall(rb'vertex\s+(\S+)\s+(\S+)\s+(\S+)', data)
+                if v:
+                    v = np.array(v, dtype=np.float32)
+                    if n_vert + len(v) > len(vertices):
+                        vertices.resize((max(2*len(vertices), n_vert + len(v)), 3), refcheck=False)
+                    vertices[n_vert:n_vert+len(v)] = v
+                    n_vert += len(v)
+
+                self.report_progress(f.tell(), size, n_vert//3)
+                if not chunk:
+                    break
+
+        if n_vert == 0 or n_vert % 3 != 0:
+            raise ValueError('Not valid ASCII STL file.')
+
+        vertices.resize((n_vert, 3), refcheck=False)
+        faces = np.arange(n_vert, dtype=np.uint32).reshape(-1, 3)
+
+        self.data.append(Mesh(vertices, faces))
+
+    def load_stl_binary(self, file_name, mmap=False, chunk_size=2**20):
+        '''Load binary STL CAD file
+
+        The triangle records are read in chunks of chunk_size triangles.
+        With mmap=True the file is memory mapped instead and the mesh only
+        keeps a strided (n_tri, 3, 3) view of the mapped triangle records.
+        Otherwise the facet normals are kept as the mesh face normals.
+        '''
+        size = os.path.getsize(file_name)
+        with open(file_name, 'rb') as f:
+            header = f.read(80)
+            # name = header.strip()
+            n_tri = int(np.frombuffer(f.read(4), dtype='<u4')[0])
+            if size < 84 + n_tri*stl_binary_dtype.itemsize:
+                raise ValueError('Truncated binary STL file.')
+
+            if mmap:
+                data = np.memmap(file_name, dtype=stl_binary_dtype, mode='r',
+                                 offset=84, shape=(n_tri,))
+                self.data.append(Mesh(None, None, triangles=data['vertices']))
+                self.report_progress(size, size, n_tri)
+                return
+
+            vertices = np.empty((n_tri, 3, 3), dtype=np.float32)
+            normals = np.empty((n_tri, 3), dtype=np.float32)
+            for i in range(0, n_tri, chunk_size):
+                data = np.fromfile(f, dtype=stl_binary_dtype, count=min(chunk_size, n_tri - i))
+                vertices[i:i+len(data)] = data['vertices']
+                normals[i:i+len(data)] = data['normal']
+                self.report_progress(f.tell(), size, i + len(data))
+
+        # Many exporters write zero normals, recompute those which are not unit length.
+        l2 = np.einsum('ij,ij->i', normals, normals)
+        bad = np.abs(l2 - 1) > 1e-3
+        if bad.all():
+            normals = None
+        elif bad.any():
+            v = vertices[bad]
+            n = np.cross(v[:,1] - v[:,0], v[:,2] - v[:,0])
+            l = np.linalg.norm(n, axis=1, keepdims=True)
+            normals[bad] = n/np.where(l > 0, l, 1)
+
+        vertices = vertices.reshape(-1, 3)
+        faces = np.arange(3*n_tri, dtype=np.uint32).reshape(-1, 3)
+
+        self.data.append(Mesh(vertices, faces, normals=normals))
+
+    def load_obj(self, file_name):
+        '''Load ASCII Wavefront OBJ CAD file
+
+        Vertex and face records are sorted by line type and their
+        numbers converted in bulk. Texture and normal indices (v/vt/vn) are
+        ignored, negative indices are resolved relative to the preceding
+        vertices, and polygons are fan triangulated so faces are always triangles.
+        '''
+        with open(file_name, 'rb') as f:
+            data = np.frombuffer(f.read() + b'\n', dtype=np.uint8)
+        # Progress is reported as the bytes of the records converted so far.
+        size = len(data) - 1
+        self.report_progress(0, size, 0)
+
+        # Sort lines into vertex and face records by their first two characters.
+        ends = np.flatnonzero(data == ord('\n'))
+        starts = np.r_[0, ends[:-1] + 1]
+        lengths = ends - starts + 1
+        is_sep = data[np.minimum(starts + 1, len(data) - 1)] <= ord(' ')
+        is_v = (data[starts] == ord('v')) & is_sep
+        is_f = (data[starts] == ord('f')) & is_sep
+
+        v_data = data[np.repeat(is_v, lengths)]
+        v_data[v_data == ord('v')] = ord(' ')
+        v_data = re.sub(rb'#[^\n]*', b'', v_data.tobytes())
+        try:
+            vertices = np.fromstring(v_data, sep=' ')
+        except ValueError:
+            vertices = None
+        if vertices is None or len(vertices) != 3*is_v.sum():
+            # Optional w or color components, parse line by line.
+            vertices = [line.split()[:3] for line in v_data.splitlines()]
+        vertices = np.array(vertices, dtype=np.float32).reshape(-1, 3)
+        n_bytes = int(lengths[is_v].sum())
+        self.report_progress(n_bytes, size, 0)
+
+        f_data = data[np.repeat(is_f, lengths)]
+        f_data[f_data == ord('f')] = ord(' ')
+        # Keep only the vertex index of each v/vt/vn face token.
+        f_data = re.sub(rb'/\S*', b'', re.sub(rb'#[^\n]*', b'', f_data.tobytes()))
+        try:
+            ind = np.fromstring(f_data, dtype=np.int64, sep=' ')
+        except ValueError:
+            ind = np.array(f_data.split(), dtype=np.int64)
+
+        # Number of vertex indices per face.
+        f_data = np.frombuffer(f_data, dtype=np.uint8)
+        is_ws = f_data <= ord(' ')
+        tok_start = np.flatnonzero(~is_ws & np.r_[True, is_ws[:-1]])
+        sizes = np.diff(np.r_[0, np.searchsorted(tok_start, np.flatnonzero(f_data == ord('\n')))])
+        if len(ind) != sizes.sum():
+            raise ValueError('Not valid OBJ file.')
+        n_bytes += int(lengths[is_f].sum())
+        self.report_progress(n_bytes, size, len(sizes))
+
+        if (ind < 0).any():
+            # Number of vertices defined before each face record.
+            n_prev = np.repeat(np.cumsum(is_v)[is_f], sizes)
+            ind = np.where(ind < 0, ind + n_prev, ind - 1)
+        else:
+            ind -= 1
+
+        if (sizes == 3).all():
+            faces = ind.reshape(-1, 3)
+        else:
+            # Fan triangulate (i0, ij, ij+1) for j = 1, ..., n-2.
+            n_tri = np.maximum(sizes - 2, 0)
+            offsets = np.cumsum(sizes) - sizes
+            i0 = np.repeat(offsets, n_tri)
+            j = np.arange(n_tri.sum()) - np.repeat(np.cumsum(n_tri) - n_tri, n_tri) + 1
+            faces = np.stack([ind[i0], ind[i0 + j], ind[i0 + j + 1]], axis=1)
+
+        self.data.append(Mesh(vertices, faces))
+        self.report_progress(size, size, len(faces))
+
+    def load_files(self, file_names, mmap=False, weld=None, max_workers=None):
+        '''Load several mesh files, directories or glob patterns
+
+        The files are parsed in parallel in a process pool and the mesh
+        arrays returned through shared memory instead of being pickled.
+        With mmap the files are memory mapped one by one instead.
+        '''
+        file_names = find_files(file_names)
+        if len(file_names) <= 1 or max_workers == 1 or mmap:
+            for file_name in file_names:
+                self.load_file(file_name, mmap, weld)
+            return
+
+        n_total = sum(os.path.getsize(file_name) for file_name in file_names)
+        n_bytes = 0
+        n_faces = 0
+        with ProcessPoolExecutor(max_workers) as executor:
+            results = [executor.submit(load_shared, file_name, weld, self.cache)
+                       for file_name in file_names]
+            try:
+                for i, result in enumerate(results):
+                    for vertices, faces in result.result():
+                        self.data.append(Mesh(unshare_array(vertices), unshare_array(faces)))
+                        n_faces += len(self.data[-1].faces)
+
+                    n_bytes += os.path.getsize(file_names[i])
+                    self.report_progress(n_bytes, n_total, n_faces)
+
+            except BaseException:
+                # Free the shared memory of results not collected yet.
+                for result in results[i+1:]:
+                    if not result.cancel() and result.exception() is None:
+                        for vertices, faces in result.result():
+                            unshare_array(vertices)
+                            unshare_array(faces)
+                raise
+
+    def report_progress(self, n_bytes, n_total, n_faces):
+        '''Pass loading progress (bytes read, file size, faces parsed)
+        to the self.progress callback, which may raise to abort loading
+        '''
+        if self.progress is not None:
+            self.progress(n_bytes, n_total, n_faces)
+
+    def get_bounds(self):
+        '''Stacked (n_meshes, 3, 2) [min, max] bounds of the meshes in self.data
+
+        Only the bounds of meshes appended since the last call are added
+        (and merged into the aggregate bounding box). If meshes were
+        removed or replaced the rows are restacked from the cached
+        Mesh.bounding_box values, without rescanning any vertices.
+        '''
+        n = len(self._bounds_data)
+        if self.data[:n] != self._bounds_data:
+            n = 0
+            self._bounds = self._bounds[:0]
+            self._bounds_data = []
+            self._bounding_box = None
+
+        if len(self.data) > n:
+            bounds = np.array([mesh.bounding_box for mesh in self.data[n:]], dtype=float).reshape(-1, 3, 2)
+            bbox = np.stack([bounds[:,:,0].min(0), bounds[:,:,1].max(0)], axis=1)
+            if self._bounding_box is not None:
+                bbox[:,0] = np.minimum(bbox[:,0], self._bounding_box[:,0])
+                bbox[:,1] = np.maximum(bbox[:,1], self._bounding_box[:,1])
+            self._bounds = np.concatenate([self._bounds, bounds])
+            self._bounds_data = self._bounds_data + self.data[n:]
+            self._bounding_box = bbox
+
+        return self._bounds
+
+    def get_bounding_box(self):
+        '''Bounding box [[x_min, x_max], [y_min, y_max], [z_min, z_max]] of
+        all meshes (None if there are none)
+        '''
+        self.get_bounds()
+        if self._bounding_box is None:
+            return None
+
+        return self._bounding_box.tolist()
+
+    def get_meshes(self, max_faces=None):
+        '''Meshes at a level of detail with at most about max_faces faces
+
+        The max_faces budget is split between the meshes in proportion to
+        their number of faces, max_faces None returns the full resolution.
+        '''
+        n_faces = sum(mesh.n_faces for mesh in self.data)
+        if max_faces is None or n_faces <= max_faces:
+            return self.data
+
+        return [mesh.get_lod(max(max_faces*mesh.n_faces//n_faces, 1)) for mesh in self.data]
+
+
+class Mesh():
+
+    __slots__ = ('triangles', '_vertices', '_faces', '_cache')
+
+    def __init__(self, vertices, faces, triangles=None, normals=None):
+        # Vertex coordinates (n_vertices, 3) and 0-based face indices
+        # (n_faces, n_face_vertices). Alternatively a (n_faces, 3, 3)
+        # triangle view, for example of a memory mapped binary STL file,
+        # from which the vertex and face arrays are created on first access.
+        # Unit face normals (n_faces, 3) read from the file are optional.
+        self.triangles = triangles
+        self._vertices = None
+        self._faces = None
+        self._cache = {}
+        if vertices is not None:
+            self.vertices = vertices
+        if faces is not None:
+            self.faces = faces
+        if normals is not None:
+            self._cache['normals'] = np.ascontiguousarray(normals, dtype=np.float32)
+
+    @property
+    def vertices(self):
+        if self._vertices is None:
+            self._vertices = np.array(self.triangles, dtype=np.float32).reshape(-1, 3)
+        return self._vertices
+
+    @vertices.setter
+    def vertices(self, vertices):
+        self._vertices = np.ascontiguousarray(vertices, dtype=np.float32)
+        self._cache = {}
+
+    @property
+    def faces(self):
+        if self._faces is None:
+            self._faces = np.arange(3*len(self.triangles), dtype=np.uint32).reshape(-1, 3)
+        return self._faces
+
+    @faces.setter
+    def faces(self, faces):
+        self._faces = np.ascontiguousarray(faces, dtype=np.uint32)
+        self._cache = {}
+
+    @property
+    def n_faces(self):
+        # Without creating the face array of a triangle view.
+        return len(self.faces if self.triangles is None else self.triangles)
+
+    @property
+    def bounding_box(self):
+        return self.cached('bounding_box', self.get_bounding_box)
+
+    def cached(self, key, fun):
+        '''Return memoized fun() result, cleared when vertices or faces change
+        '''
+        if key not in self._cache:
+            self._cache[key] = fun()
+        return self._cache[key]
+
+    def weld(self, tolerance=0):
+        '''Merge coincident vertices into an indexed mesh
+
+        Vertices are matched exactly, or with tolerance > 0 after snapping
+        to a grid with the tolerance as cell size.
+        '''
+        if tolerance > 0:
+            key = np.round(self.vertices/tolerance).astype(np.int64)
+        else:
+            key = self.vertices + np.float32(0)  # Merge -0.0 and 0.0.
+
+        # Sort and compare whole rows as single opaque items.
+        key = np.ascontiguousarray(key)
+        key = key.view(np.dtype((np.void, key.dtype.itemsize*key.shape[1]))).ravel()
+        _, ind, inv = np.unique(key, return_index=True, return_inverse=True)
+
+        faces = inv.reshape(-1).astype(np.uint32)[self.faces]
+        self.vertices = self.vertices[ind]
+        self.faces = faces
+        self.triangles = None
+        return self
+
+    def get_vertices(self):
+        '''Face vertex coordinates as (n_faces, n_face_vertices, 3) array
+        '''
+        if self.triangles is not None:
+            return self.triangles
+        return self.cached('vertices', lambda: self.vertices[self.faces])
+
+    def get_edges(self):
+        '''Unique (n_edges, 2) vertex index pairs of the face edges
+        '''
+        return self.cached('edges', self._get_edges)
+
+    def _get_edges(self):
+        faces = self.faces.astype(np.int64)
+        edges = np.stack([faces, np.roll(faces, -1, axis=1)], axis=2).reshape(-1, 2)
+        edges.sort(axis=1)
+        # Unique rows via a single int64 key per sorted (i, j) pair.
+        key = np.unique(edges[:,0] << 32 | edges[:,1])
+        return np.stack([key >> 32, key & 0xffffffff], axis=1).astype(np.uint32)
+
+    def get_line_segments(self):
+        '''Edge line segments as (n_edges, 2, 3) array of end points
+        '''
+        return self.cached('line_segments', lambda: self.vertices[self.get_edges()])
+
+    def _get_face_edges(self):
+        '''First two edge vectors (p1 - p0, p2 - p0) of each face, gathered
+        per face vertex so no (n_faces, 3, 3) coordinate copy is kept
+        '''
+        if self.triangles is not None:
+            v = self.triangles
+            return v[:,1] - v[:,0], v[:,2] - v[:,0]
+
+        vertices, faces = self.vertices, self.faces
+        p0 = vertices[faces[:,0]]
+        return vertices[faces[:,1]] - p0, vertices[faces[:,2]] - p0
+
+    def get_normals(self):
+        '''Unit face normals as (n_faces, 3) array
+        '''
+        return self.cached('normals', self._get_normals)
+
+    def _get_normals(self):
+        n = np.cross(*self._get_face_edges())
+        l = np.linalg.norm(n, axis=1, keepdims=True)
+        return n/np.where(l > 0, l, 1)
+
+    def get_vertex_normals(self):
+        '''Area weighted unit vertex normals as (n_vertices, 3) array
+        '''
+        return self.cached('vertex_normals', self._get_vertex_normals)
+
+    def _get_vertex_normals(self):
+        # Face normals scaled by twice the face area, summed at the face vertices.
+        n = np.cross(*self._get_face_edges())
+        ind = self.faces.reshape(-1)
+        n_face_vertices = self.faces.shape[1]
+        normals = np.empty((len(self.vertices), 3), dtype=np.float32)
+        for i in range(3):
+            normals[:,i] = np.bincount(ind, weights=np.repeat(n[:,i], n_face_vertices),
+                                       minlength=len(normals))
+
+        l = np.linalg.norm(normals, axis=1, keepdims=True)
+        return normals/np.where(l > 0, l, 1)
+
+    def get_lod(self, max_faces):
+        '''Finest level of detail with at most max_faces faces
+
+        Levels are vertex clustering decimations on grids of 2^(k/2)
+        cells per axis, computed from about sqrt(max_faces) cells and
+        coarser until one fits the budget, and cached.
+        '''
+        if self.n_faces <= max_faces:
+            return self
+
+        k = int(np.log2(max(max_faces, 4)))
+        while True:
+            n_cells = int(2**(k/2))
+            lod = self.cached(('lod', n_cells), lambda: self.decimate(n_cells))
+            if len(lod.faces) <= max_faces or k <= 2:
+                return lod
+            k -= 1
+
+    def decimate(self, n_cells, chunk_size=2**20):
+        '''Decimated mesh by vertex clustering on a grid with n_cells per axis
+
+        Vertices in the same grid cell are merged into their mean, and
+        collapsed and duplicate faces removed. Memory mapped triangles are
+        clustered in chunks of chunk_size triangles, without creating the
+        vertex array.
+        '''
+        bbox = np.array(self.bounding_box)
+        size = (bbox[:,1] - bbox[:,0]).max()/n_cells
+        size = size if size > 0 else 1
+
+        def get_key(vertices):
+            cell = np.floor((vertices - bbox[:,0])/size).astype(np.int64)
+            return cell[:,0] + (n_cells + 1)*(cell[:,1] + (n_cells + 1)*cell[:,2])
+
+        def remove_collapsed(faces):
+            faces = faces[(faces != np.roll(faces, -1, axis=1)).all(axis=1)]
+            # Remove duplicate faces, compared with sorted indices.
+            key = np.ascontiguousarray(np.sort(faces, axis=1))
+            key = key.view(np.dtype((np.void, key.dtype.itemsize*key.shape[1]))).ravel()
+            _, ind = np.unique(key, return_index=True)
+            return faces[np.sort(ind)]
+
+        if self.triangles is None or self._vertices is not None:
+            keys, inv, counts = np.unique(get_key(self.vertices), return_inverse=True, return_counts=True)
+            inv = inv.reshape(-1)
+            sums = np.stack([np.bincount(inv, weights=self.vertices[:,i]) for i in range(3)], axis=1)
+            faces = inv[self.faces]
+        else:
+            # Cell keys with their coordinate sums and vertex counts so far,
+            # merged with each chunk, and the faces as cell key triples.
+            keys = np.empty(0, dtype=np.int64)
+            sums = np.empty((0, 3))
+            counts = np.empty(0)
+            faces = []
+            for i in range(0, len(self.triangles), chunk_size):
+                vertices = self.triangles[i:i+chunk_size].reshape(-1, 3)
+                key = get_key(vertices)
+                keys, inv = np.unique(np.concatenate([keys, key]), return_inverse=True)
+                inv = inv.reshape(-1)
+                weights = np.concatenate([sums, vertices])
+                sums = np.stack([np.bincount(inv, weights=weights[:,j], minlength=len(keys))
+                                 for j in range(3)], axis=1)
+                counts = np.bincount(inv, weights=np.r_[counts, np.ones(len(key))], minlength=len(keys))
+                faces.append(remove_collapsed(key.reshape(-1, 3)))
+
+            faces = np.searchsorted(keys, np.concatenate(faces))
+
+        vertices = (sums/counts[:,None]).astype(np.float32)
+        return Mesh(vertices, remove_collapsed(faces))
+
+    def get_bounding_box(self, chunk_size=2**20):
+        if self.triangles is None:
+            x_min = self.vertices.min(0)
+            x_max = self.vertices.max(0)
+        else:
+            # Scan in chunks to not pull a memory mapped file into memory at once.
+            x_min = np.full(3, np.inf)
+            x_max = np.full(3, -np.inf)
+            for i in range(0, len(self.triangles), chunk_size):
+                v_i = self.triangles[i:i+chunk_size].reshape(-1, 3)
+                x_min = np.minimum(x_min, v_i.min(0))
+                x_max = np.maximum(x_max, v_i.max(0))
+
+        return [[float(x_min[i]), float(x_max[i])] for i in range(len(x_min))]
+
+
+# Version of the MeshCache entries, part of their key. Increase it
+# whenever the loaders or the stored arrays change, so that entries
+# written by an older version are not used.
+cache_version = 1
+
+
+class MeshCache():
+    '''Disk cache of loaded meshes as .npz files
+
+    Entries are keyed by the absolute source file path, size and
+    modification time (and load options and cache_version), store the
+    vertex, face and edge arrays, and the least recently used entries
+    are removed when the cache exceeds max_size bytes.
+    '''
+
+    def __init__(self, cache_dir=None, max_size=2**31):
+        if cache_dir is None:
+            cache_dir = os.environ.get('MESHVIEWER_CACHE_DIR',
+                                       os.path.join(os.path.expanduser('~'), '.cache', 'meshviewer'))
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+    def get_path(self, file_name, **options):
+        stat = os.stat(file_name)
+        key = repr((cache_version, os.path.abspath(file_name), stat.st_size, stat.st_mtime_ns,
+                    sorted(options.items())))
+        return os.path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.npz')
+
+    def load(self, file_name, **options):
+        '''Return cached mesh for file_name or None if not available
+        '''
+        path = self.get_path(file_name, **options)
+        try:
+            with np.load(path) as data:
+                mesh = Mesh(data['vertices'], data['faces'])
+                edges = data['edges']
+            os.utime(path)  # Mark as recently used.
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # Truncated or otherwise unreadable entry, parse the file instead.
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        mesh.cached('edges', lambda: edges)
+        return mesh
+
+    def save(self, file_name, mesh, **options):
+        path = self.get_path(file_name, **options)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Unique temporary file, several processes may save the same entry.
+            fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=self.cache_dir)
+        except OSError:
+            return
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, vertices=mesh.vertices, faces=mesh.faces, edges=mesh.get_edges())
+            os.replace(tmp_path, path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        self.prune()
+
+    def prune(self):
+        '''Remove least recently used entries until below max_size
+
+        Entries removed concurrently by other processes are skipped.
+        '''
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                try:
+                    stat = os.stat(os.path.join(self.cache_dir, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        size = sum(entry[1] for entry in entries)
+        for _, entry_size, name in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.cache_dir, name))
+            except OSError:
+                pass
+            size -= entry_size
+
+
+class BoundingVolumeHierarchy():
+    '''Binary tree over axis aligned bounding boxes for culling queries
+
+    The boxes are given as [[x_min, x_max], [y_min, y_max], [z_min, z_max]]
+    (as Mesh.bounding_box) and split at the median of their centers along
+    the longest axis down to leaf_size boxes per leaf.
+    '''
+
+    def __init__(self, boxes, leaf_size=4):
+        self.boxes = np.asarray(boxes, dtype=float).reshape(-1, 3, 2)
+        self.leaf_size = leaf_size
+        self.root = None
+        if len(self.boxes):
+            self.root = self.build(np.arange(len(self.boxes)))
+
+    def build(self, ind):
+        # Nodes are (lo, hi, children, box indices) tuples.
+        lo = self.boxes[ind,:,0].min(0)
+        hi = self.boxes[ind,:,1].max(0)
+        if len(ind) <= self.leaf_size:
+            return (lo, hi, None, ind)
+
+        axis = np.argmax(hi - lo)
+        ind = ind[np.argsort(self.boxes[ind,axis].sum(1), kind='stable')]
+        m = len(ind)//2
+        return (lo, hi, (self.build(ind[:m]), self.build(ind[m:])), None)
+
+    def query(self, is_visible):
+        '''Sorted indices of the boxes for which is_visible(lo, hi) is true
+
+        Subtrees are skipped when their enclosing box is not visible, so
+        is_visible must be false for all boxes inside a rejected box.
+        '''
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            lo, hi, children, ind = stack.pop()
+            if not is_visible(lo, hi):
+                continue
+            if children is None:
+                found += [int(i) for i in ind if is_visible(self.boxes[i,:,0], self.boxes[i,:,1])]
+            else:
+                stack += children
+
+        return sorted(found)
+
+
+def get_spatial_order(points, bits=10):
+    '''Indices which sort (n, 3) points along a Z-order (Morton) curve,
+    so that runs of consecutive points are spatially close
+    '''
+    lo = points.min(0)
+    size = points.max(0) - lo
+    q = ((points - lo)/np.where(size > 0, size, 1)*(2**bits - 1)).astype(np.int64)
+    # Interleave the bits of the quantized x, y and z coordinates.
+    code = np.zeros(len(points), dtype=np.int64)
+    for b in range(bits):
+        for axis in range(3):
+            code |= ((q[:,axis] >> b) & 1) << (3*b + axis)
+    return np.argsort(code, kind='stable')
+
+
+mesh_file_extensions = ('.stl', '.stla', '.stlb', '.obj')
+
+
+def find_files(file_names):
+    '''Expand directories and glob patterns to a list of mesh files
+    '''
+    found = []
+    for file_name in file_names:
+        if os.path.isdir(file_name):
+            for root, _, names in sorted(os.walk(file_name)):
+                found += [os.path.join(root, name) for name in sorted(names)
+                          if name.lower().endswith(mesh_file_extensions)]
+        elif any(c in file_name for c in '*?['):
+            found += sorted(glob.glob(file_name))
+        else:
+            found.append(file_name)
+
+    return found
+
+
+def load_shared(file_name, weld=None, cache=None):
+    '''Load file_name in a worker process and return the (vertices, faces)
+    arrays of its meshes as shared memory descriptors
+    '''
+    model = Model()
+    model.clear()
+    model.cache = cache
+    model.load_file(file_name, weld=weld)
+    return [(share_array(mesh.vertices), share_array(mesh.faces)) for mesh in model.data]
+
+
+def share_array(a):
+    '''Copy array to a new shared memory block and return its descriptor
+    '''
+    if shared_memory is None:
+        return a  # Python < 3.8, the array is pickled instead.
+
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    b = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+    b[...] = a
+    del b
+    shm.close()
+    # The receiving process takes ownership and frees the block.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return (shm.name, a.shape, a.dtype.str)
+
+
+def unshare_array(descriptor):
+    '''Copy array out of a share_array shared memory block and free it
+    '''
+    if isinstance(descriptor, np.ndarray):
+        return descriptor
+
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    b = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    a = b.copy()
+    del b
+    shm.close()
+    shm.unlink()
+    return a
+
+
+class LoadCancelled(Exception):
+    pass
+
+
+class Loader(threading.Thread):
+    '''Load a mesh file into a new Model in a background thread
+
+    The latest (bytes read, file size, faces parsed) progress is kept in
+    self.status for polling from the Tk main loop.
+    '''
+
+    def __init__(self, file_name, cache=None, mmap=False, weld=None):
+        threading.Thread.__init__(self, daemon=True)
+        model = Model()
+        model.clear()
+        model.cache = cache
+        model.mmap = mmap
+        model.weld = weld
+        model.progress = self.on_progress
+        self.model = model
+        self.file_name = file_name
+        self.status = (0, 0, 0)
+        self.error = None
+        self.cancelled = threading.Event()
+
+    def run(self):
+        try:
+            self.model.load_file(self.file_name, self.model.mmap, self.model.weld)
+        except Exception as e:
+            self.error = e
+
+    def on_progress(self, n_bytes, n_total, n_faces):
+        if self.cancelled.is_set():
+            raise LoadCancelled()
+        self.status = (n_bytes, n_total, n_faces)
+
+    def cancel(self):
+        self.cancelled.set()
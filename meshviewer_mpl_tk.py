@@ -13,22 +13,15 @@ get in touch with [Precise Simulation](https://www.precisesimulation.com).
 
 """
 
-try:
-    import tkinter as tk
-except ImportError:
-    import Tkinter as tk
-import tkinter.ttk as ttk
-import tkinter.font as tkfont
-from tkinter.filedialog import askopenfilename
-
-import matplotlib
-matplotlib.use("TkAgg")
-from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
-from matplotlib.figure import Figure
-from mpl_toolkits import mplot3d
-
-import sys
+import numpy as np
+
+from meshviewer_core import Model, MeshCache, BoundingVolumeHierarchy, get_spatial_order
+from meshviewer_tk import LoaderController, parse_args
+
+import collections
+import multiprocessing
 import os
+import time
 if os.name == "nt":
     from ctypes import windll, pointer, wintypes
     try:
@@ -36,169 +29,35 @@ if os.name == "nt":
     except Exception:
         pass  # this will fail on Windows Server and maybe early Windows
 
-
-class Model():
-
-    def __init__(self, file_name=None):
-
-        self.data = []
-        if file_name is None:
-            # Define unit cube.
-            vertices = [[0,0,0], [1,0,0], [1,1,0], [0,1,0],
-                        [0,0,1], [1,0,1], [1,1,1], [0,1,1]]
-            faces = [[1,2,3,4], [1,2,6,5], [2,3,7,6], [3,4,8,7], [4,1,5,8], [5,6,7,8]]
-            data = Mesh(vertices, faces)
-
-            self.data = [data]
-        else:
-            self.load_file(file_name)
-
-    def clear(self):
-        self.data = []
-
-    def load_file(self, file_name):
-        '''Load mesh from file
-        '''
-        if file_name.lower().endswith(('.stl','.stla','.stlb')):
-            self.load_stl(file_name)
-
-        elif file_name.lower().endswith('.obj'):
-            self.load_obj(file_name)
-
-    def load_stl(self, file_name):
-        '''Load STL CAD file
-        '''
+# Matplotlib and Tk modules, imported by import_backend when the first
+# View or Controller is created so that this module loads without them.
+tk = None
+ttk = None
+tkfont = None
+matplotlib = None
+mplot3d = None
+Figure = None
+FigureCanvasTkAgg = None
+NavigationToolbar2Tk = None
+
+
+def import_backend(tk_canvas=True):
+    '''Import Matplotlib and mplot3d, and with tk_canvas also Tk and the
+    TkAgg canvas and toolbar (not needed for offscreen rendering)
+    '''
+    global tk, ttk, tkfont, matplotlib, mplot3d, Figure, FigureCanvasTkAgg, NavigationToolbar2Tk
+    import matplotlib
+    from matplotlib.figure import Figure
+    from mpl_toolkits import mplot3d
+    if tk_canvas and FigureCanvasTkAgg is None:
         try:
-            with open(file_name, 'r') as f:
-                data = f.read()
-
-            self.load_stl_ascii(data)
-
-        except:
-            self.load_stl_binary(file_name)
-
-    def load_stl_ascii(self, data):
-        '''Load ASCII STL CAD file
-        '''
-        vertices = []
-        faces = []
-        v = []
-        for i, line in enumerate(data.splitlines()):
-            if i == 0 and line.strip() != 'solid':
-                raise ValueError('Not valid ASCII STL file.')
-
-            line_data = line.split()
-
-            if line_data[0]=='facet':
-                v = []
-
-            elif line_data[0]=='vertex':
-                v.append([float(line_data[1]), float(line_data[2]), float(line_data[3])])
-
-            elif line_data[0]=='endloop':
-                if len(v)==3:
-                    vertices.extend(v)
-                    ind = 3*len(faces)+1
-                    faces.append([ind, ind+1, ind+2])
-
-        self.data.append(Mesh(vertices, faces))
-
-    def load_stl_binary(self, file_name):
-        '''Load binary STL CAD file
-        '''
-        from struct import unpack
-        vertices = []
-        faces = []
-        with open(file_name, 'rb') as f:
-            header = f.read(80)
-            # name = header.strip()
-            n_tri = unpack('<I', f.read(4))[0]
-            for i in range(n_tri):
-                _normals = f.read(3*4)
-                for j in range(3):
-                    x = unpack('<f', f.read(4))[0]
-                    y = unpack('<f', f.read(4))[0]
-                    z = unpack('<f', f.read(4))[0]
-                    vertices.append([x, y, z])
-
-                j = 3*i + 1
-                faces.append([j, j+1, j+2])
-                _attr = f.read(2)
-
-        self.data.append(Mesh(vertices, faces))
-
-    def load_obj(self, file_name):
-        '''Load ASCII Wavefront OBJ CAD file
-        '''
-        with open(file_name, 'r') as f:
-            data = f.read()
-
-        vertices = []
-        faces = []
-        for line in data.splitlines():
-            line_data = line.split()
-            if line_data:
-                if line_data[0] == 'v':
-                    v = [float(line_data[1]), float(line_data[2]), float(line_data[3])]
-                    vertices.append(v)
-                elif line_data[0] == 'f':
-                    face = []
-                    for i in range(1, len(line_data)):
-                        s = line_data[i].replace('//','/').split('/')
-                        face.append(int(s[0]))
-
-                    faces.append(face)
-
-        self.data.append(Mesh(vertices, faces))
-
-    def get_bounding_box(self):
-        bbox = self.data[0].bounding_box
-        for mesh in self.data[1:]:
-            for i in range(len(bbox)):
-                x_i = mesh.bounding_box[i]
-                bbox[i][0] = min([bbox[i][0], min(x_i)])
-                bbox[i][1] = max([bbox[i][1], max(x_i)])
-
-        return bbox
-
-
-class Mesh():
-
-    def __init__(self, vertices, faces):
-        self.vertices = vertices
-        self.faces = faces
-        self.bounding_box = self.get_bounding_box()
-
-    def get_vertices(self):
-        vertices = []
-        for face in self.faces:
-            vertices.append([self.vertices[ivt-1] for ivt in face])
-
-        return vertices
-
-    def get_line_segments(self):
-        line_segments = set()
-        for face in self.faces:
-            for i in range(len(face)):
-                iv = face[i]
-                jv = face[(i+1)%len(face)]
-                if jv > iv:
-                    edge = (iv, jv)
-                else:
-                    edge = (jv, iv)
-
-                line_segments.add(edge)
-
-        return [[self.vertices[edge[0]-1], self.vertices[edge[1]-1]] for edge in line_segments]
-
-    def get_bounding_box(self):
-        v = [vti for face in self.get_vertices() for vti in face]
-        bbox = []
-        for i in range(len(self.vertices[0])):
-            x_i = [p[i] for p in v]
-            bbox.append([min(x_i), max(x_i)])
-
-        return bbox
+            import tkinter as tk
+        except ImportError:
+            import Tkinter as tk
+        import tkinter.ttk as ttk
+        import tkinter.font as tkfont
+        matplotlib.use("TkAgg")
+        from matplotlib.backends.backend_tkagg import (FigureCanvasTkAgg, NavigationToolbar2Tk)
 
 
 class View():
@@ -209,47 +68,217 @@ class View():
             model = Model()
         self.model = model
 
+        import_backend(tk_canvas=False)
         figure = Figure()
-        axes = mplot3d.Axes3D(figure)
+        axes = figure.add_axes([0, 0, 1, 1], projection='3d')
 
         self.figure = figure
         self.axes = axes
         self.canvas = None
         self.toolbar = None
+        # Face budget for the displayed level of detail (None for full resolution).
+        self.max_faces = 100000
+        self.full_resolution = False
+        # Stand-ins drawn while rotating/zooming, "wireframe" (decimated
+        # to proxy_faces), "bbox" or None, with full detail restored
+        # proxy_delay ms after the mouse button is released.
+        self.proxy = "wireframe"
+        self.proxy_faces = 5000
+        self.proxy_delay = 300
+        self.proxies = []
+        self.interacting = False
+        self.timer = None
+        # Meshes are drawn as spatially coherent chunks of up to chunk_faces
+        # faces (None for one collection per mesh), and chunks outside the
+        # axes limits or smaller than min_pixels are hidden.
+        self.chunk_faces = 10000
+        self.min_pixels = 2
+        self.artists = []
+        self.artist_mesh = []  # model mesh index of each artist
+        self.visible = set()
+        self.bvh = None
+        # Durations of the latest canvas draws in update (seconds).
+        self.frame_times = collections.deque(maxlen=100)
 
         self.plot()
 
     def clear(self):
         self.axes.clear()
+        self.artists = []
+        self.artist_mesh = []
+        self.proxies = []
+        self.bvh = None
         self.update()
 
     def update(self):
+        self.cull()
         if self.canvas is not None:
+            t = time.perf_counter()
             self.canvas.draw()
+            self.frame_times.append(time.perf_counter() - t)
 
     def plot(self, types="solid + wireframe"):
         self.clear()
         if isinstance(types, (str,)):
             types = [s.strip() for s in types.split('+')]
 
-        for mesh in self.model.data:
+        bounds = []
+        for i, mesh in enumerate(self.get_meshes()):
             for type in types:
 
                 if type=="solid":
-                    self.axes.add_collection3d(mplot3d.art3d.Poly3DCollection(mesh.get_vertices()))
+                    chunks = self.get_chunks(mesh, type)
+                    collections = [mplot3d.art3d.Poly3DCollection(chunk) for chunk, _ in chunks]
 
                 elif type=="wireframe":
-                    self.axes.add_collection3d(mplot3d.art3d.Line3DCollection(mesh.get_line_segments(),
-                                                                              colors=(0.1, 0.1, 0.35, 1)))
+                    chunks = self.get_chunks(mesh, type)
+                    collections = [mplot3d.art3d.Line3DCollection(chunk, colors=(0.1, 0.1, 0.35, 1))
+                                   for chunk, _ in chunks]
 
                 else:
                     # Unknown plot type
                     return None
 
+                for collection, (_, chunk_bounds) in zip(collections, chunks):
+                    self.axes.add_collection3d(collection)
+                    self.artists.append(collection)
+                    self.artist_mesh.append(i)
+                    bounds.append(chunk_bounds)
+
+        self.proxies = []
+        n_faces = sum(mesh.n_faces for mesh in self.model.data)
+        for mesh in self.model.data:
+            if self.proxy is None:
+                break
+            elif self.proxy == "bbox":
+                segments = self.get_bounding_box_segments(mesh.bounding_box)
+            else:
+                segments = mesh.get_lod(max(self.proxy_faces*mesh.n_faces//n_faces, 1)).get_line_segments()
+            proxy = mplot3d.art3d.Line3DCollection(segments, colors=(0.1, 0.1, 0.35, 1), visible=False)
+            self.axes.add_collection3d(proxy)
+            self.proxies.append(proxy)
+
+        self.bvh = BoundingVolumeHierarchy(bounds)
+        self.visible = set(range(len(self.artists)))
+
         if len(self.model.data) >= 1:
             self.axes.auto_scale_xyz(*self.model.get_bounding_box())
             self.update()
 
+    def get_chunks(self, mesh, type):
+        '''Split the (n, k, 3) face ("solid") or edge ("wireframe") coordinates
+        of mesh into (chunk, bounds) pairs of spatially coherent chunks of
+        chunk_faces items
+
+        The coordinates are gathered once, in Z-order of the face or edge
+        centers, into a single array of which the chunks are views. Only
+        this sorted array is cached on the mesh, not an unsorted copy.
+        '''
+        def get_chunks():
+            if type == "solid" and mesh.triangles is not None:
+                # Memory mapped triangles, no vertex and face arrays needed.
+                ind = None
+                n_items = len(mesh.triangles)
+            else:
+                ind = mesh.faces if type == "solid" else mesh.get_edges()
+                n_items = len(ind)
+
+            order = slice(None)
+            if self.chunk_faces is not None and n_items > self.chunk_faces:
+                if ind is None:
+                    centers = mesh.triangles.mean(1)
+                else:
+                    centers = sum(mesh.vertices[ind[:,k]] for k in range(ind.shape[1]))/ind.shape[1]
+                order = get_spatial_order(centers)
+
+            if ind is None:
+                items = np.asarray(mesh.triangles[order])
+            else:
+                items = mesh.vertices[ind[order]]
+
+            n = self.chunk_faces or max(n_items, 1)
+            chunks = [items[i:i+n] for i in range(0, len(items), n)]
+            return [(chunk, np.stack([chunk.min((0, 1)), chunk.max((0, 1))], axis=1))
+                    for chunk in chunks]
+
+        return mesh.cached(('chunks', type, self.chunk_faces), get_chunks)
+
+    def get_bounding_box_segments(self, bbox):
+        '''The 12 edges of the bounding box as (12, 2, 3) line segments
+        '''
+        corners = np.array([[bbox[0][i & 1], bbox[1][(i >> 1) & 1], bbox[2][(i >> 2) & 1]] for i in range(8)])
+        edges = [[i, i | b] for i in range(8) for b in (1, 2, 4) if not i & b]
+        return corners[edges]
+
+    def set_proxy(self, interacting):
+        '''Show the proxies instead of the meshes while interacting
+        '''
+        self.interacting = interacting
+        self.update_visibility()
+        if not interacting:
+            self.update()
+
+    def update_visibility(self):
+        for i, artist in enumerate(self.artists):
+            artist.set_visible(i in self.visible and not self.interacting)
+        meshes = {self.artist_mesh[i] for i in self.visible}
+        for i, proxy in enumerate(self.proxies):
+            proxy.set_visible(i in meshes and self.interacting)
+
+    def cull(self):
+        '''Hide mesh chunks outside the axes limits or smaller than min_pixels
+
+        The chunk bounding boxes are queried through a bounding volume
+        hierarchy, and artists only updated if the visible set changed.
+        Hidden chunks are neither projected nor depth sorted when drawing.
+        '''
+        if self.bvh is None:
+            return
+
+        lims = np.array([self.axes.get_xlim3d(), self.axes.get_ylim3d(), self.axes.get_zlim3d()])
+        proj = self.axes.get_proj()
+
+        def is_visible(lo, hi):
+            if (hi < lims[:,0]).any() or (lo > lims[:,1]).any():
+                return False
+            corners = np.stack(np.meshgrid(*zip(lo, hi), indexing='ij'), -1).reshape(-1, 3)
+            x, y, _ = mplot3d.proj3d.proj_transform(corners[:,0], corners[:,1], corners[:,2], proj)
+            p = self.axes.transData.transform(np.column_stack([x, y]))
+            return (p.max(0) - p.min(0)).max() >= self.min_pixels
+
+        visible = set(self.bvh.query(is_visible))
+        if visible != self.visible:
+            self.visible = visible
+            self.update_visibility()
+
+    def on_press(self, event):
+        if self.timer is not None:
+            self.timer.stop()
+        if event.inaxes is self.axes and self.proxies:
+            self.set_proxy(True)
+
+    def on_move(self, event):
+        if event.button is not None:
+            # Rotating or zooming, the axes have just moved the camera.
+            self.cull()
+
+    def on_release(self, event):
+        visible = self.visible
+        self.cull()
+        if self.visible is not visible and not self.interacting:
+            self.canvas.draw_idle()
+        if self.interacting:
+            # Debounce restoring full detail.
+            if self.timer is None:
+                self.timer = self.canvas.new_timer(interval=self.proxy_delay)
+                self.timer.single_shot = True
+                self.timer.add_callback(self.set_proxy, False)
+            self.timer.start()
+
+    def get_meshes(self):
+        '''Model meshes at the level of detail to display'''
+        return self.model.get_meshes(None if self.full_resolution else self.max_faces)
+
     def xy(self):
         self.axes.view_init(elev=90, azim=-90)
         self.update()
@@ -267,10 +296,11 @@ class View():
         self.update()
 
 
-class Controller():
+class Controller(LoaderController):
 
     def __init__(self, view=None):
 
+        import_backend()
         root = tk.Tk()
         root.title("Mesh Viewer")
 
@@ -295,14 +325,29 @@ class Controller():
         o1.pack()
         toolbar.append(f2)
 
+        full = tk.BooleanVar()
+        toolbar.append(tk.Checkbutton(f1, text="Full detail", variable=full,
+                                      command=lambda: self.set_full_resolution(full.get(), var)))
+
         toolbar[0].config(command=lambda: self.open(var))
 
         [obj.pack(side=tk.LEFT, anchor=tk.W) for obj in toolbar]
 
+        f4 = ttk.Frame(f1)
+        progressbar = ttk.Progressbar(f4, length=100, maximum=1.0)
+        progressbar.pack(side=tk.LEFT, padx=4)
+        status = tk.Label(f4)
+        status.pack(side=tk.LEFT)
+        tk.Button(f4, text="Cancel", command=self.cancel).pack(side=tk.LEFT)
+        self.status_frame = f4
+        self.progressbar = progressbar
+        self.status = status
+        self.loader = None
+
         canvas = FigureCanvasTkAgg(view.figure, root)
-        canvas.mpl_connect('button_press_event', view.axes._button_press)
-        canvas.mpl_connect('button_release_event', view.axes._button_release)
-        canvas.mpl_connect('motion_notify_event', view.axes._on_move)
+        canvas.mpl_connect('button_press_event', view.on_press)
+        canvas.mpl_connect('button_release_event', view.on_release)
+        canvas.mpl_connect('motion_notify_event', view.on_move)
         canvas.draw()
         canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=True)
 
@@ -323,18 +368,8 @@ class Controller():
         self.view = view
         self.model = view.model
 
-    def render(self):
-        self.root.mainloop()
-
-    def open(self, var):
-        file_name = askopenfilename( title = "Select file to open",
-                                     filetypes = (("CAD files","*.obj;*.stl"),
-                                                  ("all files","*.*")) )
-        self.model.clear()
-        self.model.load_file(file_name)
-        self.view.plot(var.get())
-
     def exit(self):
+        self.cancel()
         self.model.clear()
         self.view.clear()
         self.root.destroy()
@@ -355,12 +390,10 @@ def setMaxWidth(stringList, element):
 class App():
 
     def __init__(self, model=None, view=None, controller=None):
-        file_name = None
-        if len(sys.argv) >= 2:
-            file_name = sys.argv[1]
+        args = parse_args()
 
         if model is None:
-            model = Model(file_name)
+            model = Model(args.files or None, mmap=args.mmap, weld=args.weld, cache=MeshCache())
 
         if view is None:
             view = View(model)
@@ -378,5 +411,6 @@ class App():
 
 if __name__ == "__main__":
 
+    multiprocessing.freeze_support()
     app = App()
     app.start()
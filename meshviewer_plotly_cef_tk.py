@@ -19,10 +19,10 @@ except ImportError:
     import Tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.font as tkfont
-from tkinter.filedialog import askopenfilename
 
-from cefpython3 import cefpython as cef
+import base64
 import ctypes
+import multiprocessing
 import sys
 import os
 if os.name == "nt":
@@ -32,178 +32,53 @@ if os.name == "nt":
     except Exception:
         pass  # this will fail on Windows Server and maybe early Windows
 
+import pathlib
 import platform
+import tempfile
 
 import numpy as np
 
+from meshviewer_core import Model, MeshCache
+from meshviewer_tk import LoaderController, parse_args
+
 g_multi_threaded = True
 if not platform.system() == "Windows":
     g_multi_threaded = False
 
+plotly_js_cdn_url = "https://cdn.plot.ly/plotly-latest.min.js"
 
-class Model():
-
-    def __init__(self, file_name=None):
-
-        self.data = []
-        if file_name is None:
-            # Define unit cube.
-            vertices = [[0,0,0], [1,0,0], [1,1,0], [0,1,0],
-                        [0,0,1], [1,0,1], [1,1,1], [0,1,1]]
-            faces = [[1,2,3], [1,3,4], [1,2,6], [1,6,5], [2,3,7], [2,7,6],
-                     [3,4,8], [3,8,7], [4,1,5], [4,5,8], [5,6,7], [5,7,8]]
-            data = Mesh(vertices, faces)
-
-            self.data = [data]
-        else:
-            self.load_file(file_name)
-
-    def clear(self):
-        self.data = []
-
-    def load_file(self, file_name):
-        '''Load mesh from file
-        '''
-        if file_name.lower().endswith(('.stl','.stla','.stlb')):
-            self.load_stl(file_name)
-
-        elif file_name.lower().endswith('.obj'):
-            self.load_obj(file_name)
-
-    def load_stl(self, file_name):
-        '''Load STL CAD file
-        '''
-        try:
-            with open(file_name, 'r') as f:
-                data = f.read()
-
-            self.load_stl_ascii(data)
-
-        except:
-            self.load_stl_binary(file_name)
-
-    def load_stl_ascii(self, data):
-        '''Load ASCII STL CAD file
-        '''
-        vertices = []
-        faces = []
-        v = []
-        for i, line in enumerate(data.splitlines()):
-            if i == 0 and line.strip() != 'solid':
-                raise ValueError('Not valid ASCII STL file.')
-
-            line_data = line.split()
-
-            if line_data[0]=='facet':
-                v = []
-
-            elif line_data[0]=='vertex':
-                v.append([float(line_data[1]), float(line_data[2]), float(line_data[3])])
-
-            elif line_data[0]=='endloop':
-                if len(v)==3:
-                    vertices.extend(v)
-                    ind = 3*len(faces)+1
-                    faces.append([ind, ind+1, ind+2])
-
-        self.data.append(Mesh(vertices, faces))
-
-    def load_stl_binary(self, file_name):
-        '''Load binary STL CAD file
-        '''
-        from struct import unpack
-        vertices = []
-        faces = []
-        with open(file_name, 'rb') as f:
-            header = f.read(80)
-            # name = header.strip()
-            n_tri = unpack('<I', f.read(4))[0]
-            for i in range(n_tri):
-                _normals = f.read(3*4)
-                for j in range(3):
-                    x = unpack('<f', f.read(4))[0]
-                    y = unpack('<f', f.read(4))[0]
-                    z = unpack('<f', f.read(4))[0]
-                    vertices.append([x, y, z])
-
-                j = 3*i + 1
-                faces.append([j, j+1, j+2])
-                _attr = f.read(2)
-
-        self.data.append(Mesh(vertices, faces))
-
-    def load_obj(self, file_name):
-        '''Load ASCII Wavefront OBJ CAD file
-        '''
-        with open(file_name, 'r') as f:
-            data = f.read()
-
-        vertices = []
-        faces = []
-        for line in data.splitlines():
-            line_data = line.split()
-            if line_data:
-                if line_data[0] == 'v':
-                    v = [float(line_data[1]), float(line_data[2]), float(line_data[3])]
-                    vertices.append(v)
-                elif line_data[0] == 'f':
-                    face = []
-                    for i in range(1, len(line_data)):
-                        s = line_data[i].replace('//','/').split('/')
-                        face.append(int(s[0]))
-
-                    faces.append(face)
+# CEF Python, imported by import_backend when the first View is created
+# so that this module loads without it.
+cef = None
 
-        self.data.append(Mesh(vertices, faces))
 
-    def get_bounding_box(self):
-        bbox = self.data[0].bounding_box
-        for mesh in self.data[1:]:
-            for i in range(len(bbox)):
-                x_i = mesh.bounding_box[i]
-                bbox[i][0] = min([bbox[i][0], min(x_i)])
-                bbox[i][1] = max([bbox[i][1], max(x_i)])
+def import_backend():
+    '''Import CEF Python
+    '''
+    global cef
+    if cef is None:
+        from cefpython3 import cefpython as cef
 
-        return bbox
 
+def get_plotly_js_url():
+    '''URL of a local plotly.min.js bundle, or the CDN if none is found
 
-class Mesh():
-
-    def __init__(self, vertices, faces):
-        self.vertices = vertices
-        self.faces = faces
-        self.bounding_box = self.get_bounding_box()
-
-    def get_vertices(self):
-        vertices = []
-        for face in self.faces:
-            vertices.append([self.vertices[ivt-1] for ivt in face])
-
-        return vertices
-
-    def get_line_segments(self):
-        line_segments = set()
-        for face in self.faces:
-            for i in range(len(face)):
-                iv = face[i]
-                jv = face[(i+1)%len(face)]
-                if jv > iv:
-                    edge = (iv, jv)
-                else:
-                    edge = (jv, iv)
-
-                line_segments.add(edge)
-
-        return [[self.vertices[edge[0]-1], self.vertices[edge[1]-1]] for edge in line_segments]
+    The bundle is looked for in MESHVIEWER_PLOTLY_JS, next to this script
+    (or in the PyInstaller bundle), and in the plotly Python package.
+    '''
+    file_names = [os.environ.get('MESHVIEWER_PLOTLY_JS', ''),
+                  os.path.join(getattr(sys, '_MEIPASS', os.path.dirname(os.path.abspath(__file__))), 'plotly.min.js')]
+    try:
+        import plotly
+        file_names.append(os.path.join(os.path.dirname(plotly.__file__), 'package_data', 'plotly.min.js'))
+    except ImportError:
+        pass
 
-    def get_bounding_box(self):
-        v = [vti for face in self.get_vertices() for vti in face]
-        bbox = []
-        for i in range(len(self.vertices[0])):
-            x_i = [p[i] for p in v]
-            bbox.append([min(x_i), max(x_i)])
+    for file_name in file_names:
+        if file_name and os.path.isfile(file_name):
+            return pathlib.Path(os.path.abspath(file_name)).as_uri()
 
-        return bbox
+    return plotly_js_cdn_url
 
 
 class View():
@@ -214,59 +89,78 @@ class View():
             model = Model()
 
         self.model = model
+        import_backend()
         self.browserframe = None
         self.browser = None
+        self.traces = []  # (mesh, type) of the traces in the browser
+        self.types = "solid + wireframe"
+        self.html_file = None
+        # Face budget for the displayed level of detail (None for full resolution).
+        self.max_faces = 100000
+        self.full_resolution = False
 
     def clear(self):
-        s_cmd = 'Plotly.deleteTraces("canvas", [...data.keys()]);'
-        self.browser.ExecuteJavascript(s_cmd)
-
-    def update(self):
-        s_cmd = self.get_plot_cmd()
-        self.browser.ExecuteJavascript(s_cmd)
-
-    def plot(self, types="solid + wireframe"):
-        self.clear()
-        if len(self.model.data) >= 1:
-            s_cmd = self.get_model_data(types)
+        if self.traces:
+            s_cmd = 'Plotly.deleteTraces("canvas", ' + str(list(range(len(self.traces)))) + ');'
             self.browser.ExecuteJavascript(s_cmd)
-            self.update()
+            self.traces = []
 
-    def get_plot_cmd(self):
-        s_layout = '{"showlegend": false, "scene": {"aspectratio": {"x": 1, "y": 1, "z": 1}, "aspectmode": "manual"}}'
-        s_config = '{"responsive": true}'
-        s = 'Plotly.plot("canvas", data, ' + s_layout + ', ' + s_config +');'
-        return s
-
-    def get_model_data(self, types="solid + wireframe"):
+    def plot(self, types="solid + wireframe"):
+        '''Show the model meshes as types ("solid", "wireframe")
 
+        Traces stay resident in the browser, so only the traces of new
+        meshes and types are sent, removed meshes are deleted and the
+        rest are shown or hidden with a visibility restyle.
+        '''
+        self.types = types
         if isinstance(types, (str,)):
             types = [s.strip() for s in types.split('+')]
+        if any(type not in ("solid", "wireframe") for type in types):
+            # Unknown plot type
+            return None
+
+        meshes = self.get_meshes()
+        ind = [i for i, (mesh, _) in enumerate(self.traces)
+               if not any(mesh is data for data in meshes)]
+        if ind:
+            s_cmd = 'Plotly.deleteTraces("canvas", ' + str(ind) + ');'
+            self.browser.ExecuteJavascript(s_cmd)
+            self.traces = [trace for i, trace in enumerate(self.traces) if i not in ind]
 
-        s = 'var data = ['
-        for mesh in self.model.data:
-            for type in types:
+        traces = [(mesh, type) for mesh in meshes for type in types
+                  if not any(t[0] is mesh and t[1] == type for t in self.traces)]
+        if traces:
+            s_data = ', '.join(self.get_trace_data(mesh, type) for mesh, type in traces)
+            s_cmd = 'Plotly.addTraces("canvas", [' + s_data + ']);'
+            self.browser.ExecuteJavascript(s_cmd)
+            self.traces += traces
 
-                if type=="solid":
-                    s += self.get_plotly_mesh3d_data(mesh) + ', '
+        if self.traces:
+            s_visible = str([type in types for _, type in self.traces]).replace('True', 'true').replace('False', 'false')
+            s_cmd = 'Plotly.restyle("canvas", {"visible": ' + s_visible + '}, ' + \
+                str(list(range(len(self.traces)))) + ');'
+            self.browser.ExecuteJavascript(s_cmd)
 
-                elif type=="wireframe":
-                    s += self.get_plotly_scatter3d_data(mesh) + ', '
+    def get_plot_cmd(self):
+        s_layout = '{"showlegend": false, "scene": {"aspectratio": {"x": 1, "y": 1, "z": 1}, "aspectmode": "manual"}}'
+        s_config = '{"responsive": true}'
+        s = 'Plotly.newPlot("canvas", data, ' + s_layout + ', ' + s_config +');'
+        return s
 
-                else:
-                    # Unknown plot type
-                    return None
+    def get_trace_data(self, mesh, type):
+        if type=="solid":
+            return self.get_plotly_mesh3d_data(mesh)
 
-        s = s[:-2] + '];'
-        return s
+        elif type=="wireframe":
+            return self.get_plotly_scatter3d_data(mesh)
 
     def get_plotly_mesh3d_data(self, mesh):
-        s_x = str([x[0] for x in mesh.vertices])
-        s_y = str([x[1] for x in mesh.vertices])
-        s_z = str([x[2] for x in mesh.vertices])
-        s_i = str([f[0]-1 for f in mesh.faces])
-        s_j = str([f[1]-1 for f in mesh.faces])
-        s_k = str([f[2]-1 for f in mesh.faces])
+        s_x = self.get_js_array(mesh.vertices[:,0])
+        s_y = self.get_js_array(mesh.vertices[:,1])
+        s_z = self.get_js_array(mesh.vertices[:,2])
+        s_i = self.get_js_array(mesh.faces[:,0], 'uint32')
+        s_j = self.get_js_array(mesh.faces[:,1], 'uint32')
+        s_k = self.get_js_array(mesh.faces[:,2], 'uint32')
         s = '{"type": "mesh3d", "name": "faces", "hoverinfo": "x+y+z", ' + \
             '"x": ' + s_x + ', "y": ' + s_y + ', "z": ' + s_z + ', ' \
             '"i": ' + s_i + ', "j": ' + s_j + ', "k": ' + s_k + ', ' \
@@ -274,31 +168,44 @@ class View():
         return s
 
     def get_plotly_scatter3d_data(self, mesh):
-        s_x = ''
-        s_y = ''
-        s_z = ''
-        for line in mesh.get_line_segments():
-            s_x += str(line[0][0]) + ', ' + str(line[1][0]) + ', null, '
-            s_y += str(line[0][1]) + ', ' + str(line[1][1]) + ', null, '
-            s_z += str(line[0][2]) + ', ' + str(line[1][2]) + ', null, '
-
-        s_x = s_x[:-8]
-        s_y = s_y[:-8]
-        s_z = s_z[:-8]
+        # Line segments separated by NaN (gap) points.
+        segments = mesh.get_line_segments()
+        lines = np.full((len(segments), 3, 3), np.nan, dtype=np.float32)
+        lines[:,:2] = segments
+        lines = lines.reshape(-1, 3)[:-1]
+        s_x = self.get_js_array(lines[:,0])
+        s_y = self.get_js_array(lines[:,1])
+        s_z = self.get_js_array(lines[:,2])
 
         s = '{"type": "scatter3d", "name": "", "mode": "lines", "hoverinfo": "x+y+z", ' + \
-            '"x": [' + s_x + '], "y": [' + s_y + '], "z": [' + s_z + '], "showlegend": false, ' + \
+            '"x": ' + s_x + ', "y": ' + s_y + ', "z": ' + s_z + ', "showlegend": false, ' + \
             '"line": {"color": "rgb(0,0,0)", "width": 2, "dash": "solid", "showscale": false}}'
         return s
 
+    def get_js_array(self, a, dtype='float32'):
+        '''JavaScript expression decoding array a as base64 encoded typed array
+        '''
+        a = np.ascontiguousarray(a, dtype=np.dtype(dtype).newbyteorder('<'))
+        s_type = {'float32': 'Float32Array', 'uint32': 'Uint32Array'}[dtype]
+        return 'b64("' + base64.b64encode(a).decode('ascii') + '", ' + s_type + ')'
+
+    def get_js_functions(self):
+        # Decode base64 string s to typed array of type T (little-endian).
+        s = 'function b64(s, T) {' + \
+            'var b = atob(s), u = new Uint8Array(b.length);' + \
+            'for (var i = 0; i < b.length; i++) { u[i] = b.charCodeAt(i); }' + \
+            'return new T(u.buffer); }'
+        return s
+
     def get_plotly_html_canvas(self):
         s_title = 'Mesh Viewer'
 
         s_body = '<div id="load" style="margin:0.5em">Loading Plotly ...</div>' + \
             '<div id="canvas" style="width:100vw; height:100vh;" class="plotly-graph-div"></div>' + \
-            '<script src="https://cdn.plot.ly/plotly-latest.min.js" charset="utf-8"></script>' + \
+            '<script src="' + get_plotly_js_url() + '" charset="utf-8"></script>' + \
             '<script>' + \
-            self.get_model_data() + \
+            self.get_js_functions() + \
+            'var data = [];' + \
             'var elem = document.getElementById("load"); elem.parentNode.removeChild(elem);' + \
             self.get_plot_cmd() + \
             '</script>'
@@ -308,6 +215,20 @@ class View():
 
         return s_html
 
+    def load_html(self):
+        '''Load the empty plot page, the model is sent by on_load
+        '''
+        fd, file_name = tempfile.mkstemp(prefix='meshviewer', suffix='.html')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(self.get_plotly_html_canvas())
+
+        self.html_file = file_name
+        self.browser.LoadUrl(pathlib.Path(file_name).as_uri())
+
+    def on_load(self):
+        self.traces = []
+        self.plot(self.types)
+
     def set_html(self, s_html):
 
         s_cmd = 'document.open("text/html");' + \
@@ -316,6 +237,10 @@ class View():
 
         self.browser.ExecuteJavascript(s_cmd)
 
+    def get_meshes(self):
+        '''Model meshes at the level of detail to display'''
+        return self.model.get_meshes(None if self.full_resolution else self.max_faces)
+
     def xy(self):
         bbox = self.model.get_bounding_box()
         d = 2*(bbox[2][1] - bbox[2][0])
@@ -339,7 +264,7 @@ class View():
         self.browser.ExecuteJavascript(s_cmd)
 
 
-class Controller():
+class Controller(LoaderController):
 
     def __init__(self, view=None):
 
@@ -369,10 +294,25 @@ class Controller():
         o1.pack()
         toolbar.append(f2)
 
+        full = tk.BooleanVar()
+        toolbar.append(tk.Checkbutton(f1, text="Full detail", variable=full,
+                                      command=lambda: self.set_full_resolution(full.get(), var)))
+
         toolbar[0].config(command=lambda: self.open(var))
 
         [obj.pack(side=tk.LEFT, anchor=tk.W) for obj in toolbar]
 
+        f4 = ttk.Frame(f1)
+        progressbar = ttk.Progressbar(f4, length=100, maximum=1.0)
+        progressbar.pack(side=tk.LEFT, padx=4)
+        status = tk.Label(f4)
+        status.pack(side=tk.LEFT)
+        tk.Button(f4, text="Cancel", command=self.cancel).pack(side=tk.LEFT)
+        self.status_frame = f4
+        self.progressbar = progressbar
+        self.status = status
+        self.loader = None
+
         f3 = tk.Frame(root)
         f3.bind("<Configure>", self.on_configure)
         f3.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
@@ -403,19 +343,12 @@ class Controller():
         cef.Initialize(settings=settings)
         self.root.mainloop()
 
-    def open(self, var):
-        file_name = askopenfilename( title = "Select file to open",
-                                     filetypes = (("CAD files","*.obj;*.stl"),
-                                                  ("all files","*.*")) )
-        self.model.clear()
-        self.model.load_file(file_name)
-        self.view.plot(var.get())
-
     def on_configure(self, event):
         if self.view.browserframe:
             self.view.browserframe.on_mainframe_configure(event.width, event.height)
 
     def exit(self):
+        self.cancel()
         self.model.clear()
         self.view.set_html('<!DOCTYPE HTML><html">Shutting down ...</html>')
         if g_multi_threaded:
@@ -426,6 +359,8 @@ class Controller():
         self.root.destroy()
         if not g_multi_threaded:
             cef.Shutdown()
+        if self.view.html_file is not None:
+            os.remove(self.view.html_file)
 
 
 def setMaxWidth(stringList, element):
@@ -443,12 +378,10 @@ def setMaxWidth(stringList, element):
 class App():
 
     def __init__(self, model=None, view=None, controller=None):
-        file_name = None
-        if len(sys.argv) >= 2:
-            file_name = sys.argv[1]
+        args = parse_args()
 
         if model is None:
-            model = Model(file_name)
+            model = Model(args.files or None, mmap=args.mmap, weld=args.weld, cache=MeshCache())
 
         if view is None:
             view = View(model)
@@ -509,7 +442,7 @@ class BrowserFrame(tk.Frame):
             self.browser.SetClientHandler(LoadHandler(self))
             self.browser.SetClientHandler(FocusHandler(self))
             self.view.browser = self.browser
-            self.view.set_html(self.view.get_plotly_html_canvas())
+            self.view.load_html()
             if not g_multi_threaded:
                 self.message_loop_work()
 
@@ -569,6 +502,16 @@ class LoadHandler(object):
     def OnLoadStart(self, browser, **_):
         pass
 
+    def OnLoadEnd(self, browser, frame, **_):
+        view = self.browser_frame.view
+        if frame.IsMain() and view.html_file is not None and \
+           frame.GetUrl() == pathlib.Path(view.html_file).as_uri():
+            if g_multi_threaded:
+                # Called on the CEF UI thread, plot on the Tk thread.
+                self.browser_frame.after(0, view.on_load)
+            else:
+                view.on_load()
+
 class FocusHandler(object):
 
     def __init__(self, browser_frame):
@@ -586,6 +529,8 @@ class FocusHandler(object):
 
 if __name__ == "__main__":
 
+    multiprocessing.freeze_support()
+    import_backend()
     assert cef.__version__ >= "55.3", "CEF Python v55.3+ required to run this"
     sys.excepthook = cef.ExceptHook
     app = App()
@@ -0,0 +1,137 @@
+"""Headless batch rendering of STL/OBJ preview images with the
+Matplotlib Mesh Viewer Model and View classes and the Agg backend.
+
+    python meshviewer_render.py [-o OUTPUT_DIR] [-j JOBS] [--size PIXELS]
+                                [--views xy,xz,yz,iso] [--types solid]
+                                FILE_OR_DIR_OR_GLOB ...
+
+Each file is rendered to OUTPUT_DIR/<name>_<ext>_<view>.png for the XY, XZ,
+YZ and isometric (reset) camera presets, and the files are spread over
+a process pool.
+
+:license: AGPL v3, see LICENSE for more details or contact
+          Precise Simulation for alternative licensing options.
+:copyright: 2020 Precise Simulation Ltd.
+
+"""
+
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+from meshviewer_core import Model, find_files
+from meshviewer_mpl_tk import View
+
+view_presets = {"xy": View.xy, "xz": View.xz, "yz": View.yz, "iso": View.reset}
+
+
+def render_file(file_name, output_dir, views=("xy", "xz", "yz", "iso"),
+                size=400, types="solid"):
+    '''Render file_name for the view presets and return the image file names
+    '''
+    model = Model()
+    model.clear()
+    view = View(model)
+    view.proxy = None
+
+    model.load_file(file_name)
+    view.plot(types)
+
+    dpi = 100
+    view.figure.set_size_inches(size/dpi, size/dpi)
+    canvas = FigureCanvasAgg(view.figure)
+
+    name = get_image_name(file_name)
+    os.makedirs(output_dir, exist_ok=True)
+    image_names = []
+    for preset in views:
+        view_presets[preset](view)
+        view.cull()
+        image_name = os.path.join(output_dir, name + "_" + preset + ".png")
+        canvas.print_png(image_name)
+        image_names.append(image_name)
+
+    return image_names
+
+
+def get_image_name(file_name):
+    '''Image file name prefix of file_name, its file name with "_" for "."
+    '''
+    return os.path.basename(file_name).replace(".", "_")
+
+
+def get_output_dirs(file_names, output_dir):
+    '''Expand file_names to (mesh file, image directory) pairs
+
+    Files found in a directory argument are written to the same
+    subdirectories of output_dir, so equally named files in different
+    directories do not overwrite each other's images.
+    '''
+    outputs = []
+    for file_name in file_names:
+        for found in find_files([file_name]):
+            if os.path.isdir(file_name):
+                subdir = os.path.dirname(os.path.relpath(found, file_name))
+                outputs.append((found, os.path.join(output_dir, subdir)))
+            else:
+                outputs.append((found, output_dir))
+
+    return outputs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render STL/OBJ files to PNG images.")
+    parser.add_argument("files", nargs="+", help="mesh files, directories or glob patterns")
+    parser.add_argument("-o", "--output-dir", default=".", help="output directory")
+    parser.add_argument("-j", "--jobs", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--size", type=int, default=400, help="image size in pixels")
+    parser.add_argument("--views", default="xy,xz,yz,iso", help="comma separated view presets")
+    parser.add_argument("--types", default="solid", help='plot types, for example "solid + wireframe"')
+    args = parser.parse_args(argv)
+
+    views = [s.strip() for s in args.views.split(",")]
+    for preset in views:
+        if preset not in view_presets:
+            parser.error("unknown view preset " + preset)
+
+    outputs = get_output_dirs(args.files, args.output_dir)
+    image_files = {}
+    for file_name, output_dir in outputs:
+        key = os.path.normcase(os.path.join(output_dir, get_image_name(file_name)))
+        if key in image_files:
+            parser.error("%s and %s would write the same images" % (image_files[key], file_name))
+        image_files[key] = file_name
+
+    file_names = [file_name for file_name, _ in outputs]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    n_failed = 0
+    t_start = time.time()
+    with ProcessPoolExecutor(args.jobs) as executor:
+        results = [executor.submit(render_file, file_name, output_dir, views, args.size, args.types)
+                   for file_name, output_dir in outputs]
+        for file_name, result in zip(file_names, results):
+            try:
+                result.result()
+                print(file_name)
+            except Exception as e:
+                n_failed += 1
+                print(file_name + ": " + str(e), file=sys.stderr)
+
+    t = time.time() - t_start
+    n_files = len(file_names) - n_failed
+    print("Rendered %d files in %.2f s (%.2f files/s), %d failed" %
+          (n_files, t, n_files/t if t > 0 else 0, n_failed))
+
+    return 1 if n_failed else 0
+
+
+if __name__ == "__main__":
+
+    multiprocessing.freeze_support()
+    sys.exit(main())
@@ -0,0 +1,90 @@
+"""Shared Tk controller code of the STL/OBJ Python Mesh Viewer prototypes.
+
+Command line parsing and background file loading with a progress bar
+used by the Controller classes of the Matplotlib, Plotly/CEF and VisPy
+viewers. The Tk dialogs are imported when used, so that the viewer
+modules can be imported for offscreen rendering without Tk.
+
+:license: AGPL v3, see LICENSE for more details or contact
+          Precise Simulation for alternative licensing options.
+:copyright: 2020 Precise Simulation Ltd.
+
+"""
+
+import argparse
+
+from meshviewer_core import Loader, LoadCancelled
+
+
+def parse_args(argv=None):
+    '''Parse the viewer command line: mesh files, directories or glob
+    patterns to open and load options
+    '''
+    parser = argparse.ArgumentParser(description="STL/OBJ mesh viewer.")
+    parser.add_argument("files", nargs="*", help="mesh files, directories or glob patterns")
+    parser.add_argument("--mmap", action="store_true",
+                        help="memory map binary STL files instead of reading them (bypasses the mesh cache)")
+    parser.add_argument("--weld", type=float, default=None, metavar="TOLERANCE",
+                        help="merge vertices closer than TOLERANCE (0 for exact matches)")
+    return parser.parse_args(argv)
+
+
+class LoaderController():
+    '''Background file loading for the Tk controllers
+
+    Expects self.root, self.model, self.view and a status_frame with a
+    progressbar and status label, which is shown while loading.
+    '''
+
+    def set_full_resolution(self, full_resolution, var):
+        self.view.full_resolution = full_resolution
+        self.view.plot(var.get())
+
+    def render(self):
+        self.root.mainloop()
+
+    def open(self, var):
+        from tkinter.filedialog import askopenfilename
+
+        file_name = askopenfilename( title = "Select file to open",
+                                     filetypes = (("CAD files","*.obj;*.stl"),
+                                                  ("all files","*.*")) )
+        if not file_name:
+            return
+
+        # Load in the background and keep the current model until done.
+        self.cancel()
+        self.loader = Loader(file_name, self.model.cache, self.model.mmap, self.model.weld)
+        self.loader.start()
+        self.progressbar["value"] = 0
+        self.status.config(text="Loading ...")
+        self.status_frame.pack(side="left", anchor="w")
+        self.root.after(100, self.poll_loader, self.loader, var)
+
+    def poll_loader(self, loader, var):
+        from tkinter.messagebox import showerror
+
+        if loader is not self.loader:
+            return
+
+        if loader.is_alive():
+            n_bytes, n_total, n_faces = loader.status
+            if n_total > 0:
+                self.progressbar["value"] = n_bytes/n_total
+            self.status.config(text="Loading %d faces" % n_faces)
+            self.root.after(100, self.poll_loader, loader, var)
+            return
+
+        self.loader = None
+        self.status_frame.pack_forget()
+        if loader.error is None:
+            self.model.data = loader.model.data
+            self.view.plot(var.get())
+        elif not isinstance(loader.error, LoadCancelled):
+            showerror("Mesh Viewer", "Could not open " + loader.file_name + "\n\n" + str(loader.error))
+
+    def cancel(self):
+        if self.loader is not None:
+            self.loader.cancel()
+            self.loader = None
+            self.status_frame.pack_forget()
@@ -19,16 +19,13 @@ except ImportError:
     import Tkinter as tk
 import tkinter.ttk as ttk
 import tkinter.font as tkfont
-from tkinter.filedialog import askopenfilename
-
-import vispy
-import vispy.scene
-# import vispy.visuals
-vispy.use(app='tkinter')
 
 import numpy as np
 
-import sys
+from meshviewer_core import Model, MeshCache, BoundingVolumeHierarchy
+from meshviewer_tk import LoaderController, parse_args
+
+import multiprocessing
 import os
 if os.name == 'nt':
     from ctypes import windll, pointer, wintypes
@@ -37,81 +34,21 @@ if os.name == 'nt':
     except Exception:
         pass  # this will fail on Windows Server and maybe early Windows
 
+# VisPy, imported by import_backend when the first View is created so
+# that this module loads without it.
+vispy = None
 
-class Model():
-
-    def __init__(self, file_name=None):
-
-        self.data = []
-        if file_name is None:
-            # Define unit cube.
-            vertices = [[0,1,0], [1,1,0], [1,0,0], [0,0,0],
-                        [1,0,1], [0,0,1], [1,1,1], [0,1,1]]
-            faces = [[0,1,2], [0,2,3], [2,4,5], [2,5,3], [4,2,1], [4,1,6],
-                     [6,1,0], [6,0,7], [3,5,7], [3,7,0], [6,5,4], [6,7,5]]
-            data = Mesh(np.asarray(vertices, dtype='float32'), np.asarray(faces,dtype='uint32'))
-
-            self.data = [data]
-        else:
-            self.load_file(file_name)
-
-    def clear(self):
-        self.data = []
-
-    def load_file(self, file_name):
-        '''Load mesh from file
-        '''
-        vertices, faces, _, _ = vispy.io.read_mesh(file_name)
-        self.data.append(Mesh(vertices, faces))
-
-    def get_bounding_box(self):
-        bbox = self.data[0].bounding_box
-        for mesh in self.data[1:]:
-            for i in range(len(bbox)):
-                x_i = mesh.bounding_box[i]
-                bbox[i][0] = min([bbox[i][0], min(x_i)])
-                bbox[i][1] = max([bbox[i][1], max(x_i)])
-
-        return bbox
-
-
-class Mesh():
-
-    def __init__(self, vertices, faces):
-        self.vertices = vertices
-        self.faces = faces
-        self.bounding_box = self.get_bounding_box()
-
-    def get_vertices(self):
-        vertices = []
-        for face in self.faces:
-            vertices.append([self.vertices[ivt] for ivt in face])
-
-        return vertices
-
-    def get_line_segments(self):
-        line_segments = set()
-        for face in self.faces:
-            for i in range(len(face)):
-                iv = face[i]
-                jv = face[(i+1)%len(face)]
-                if jv > iv:
-                    edge = (iv, jv)
-                else:
-                    edge = (jv, iv)
 
-                line_segments.add(edge)
-
-        return [[self.vertices[edge[0]-1], self.vertices[edge[1]-1]] for edge in line_segments]
-
-    def get_bounding_box(self):
-        v = [vti for face in self.get_vertices() for vti in face]
-        bbox = []
-        for i in range(len(self.vertices[0])):
-            x_i = [p[i] for p in v]
-            bbox.append([min(x_i), max(x_i)])
-
-        return bbox
+def import_backend():
+    '''Import VisPy and select its Tkinter app backend
+    '''
+    global vispy
+    if vispy is None:
+        import vispy
+        import vispy.geometry
+        import vispy.scene
+        # import vispy.visuals
+        vispy.use(app='tkinter')
 
 
 class View():
@@ -121,42 +58,142 @@ class View():
         if model is None:
             model = Model()
         self.model = model
+        import_backend()
         self.canvas = None
         self.vpview = None
+        # Face budget for the displayed level of detail (None for full resolution).
+        self.max_faces = 10000000
+        self.full_resolution = False
+        # Meshes outside the view or smaller than min_pixels are hidden.
+        self.min_pixels = 2
+        # Per mesh {type: visual} of the displayed meshes, and the model
+        # meshes they were created for.
+        self.visuals = []
+        self.meshes = []
+        self.data = []
+        self.types = []
+        self.visible = set()
+        self.bvh = None
 
     def clear(self):
-        if self.vpview is not None:
-            self.vpview.parent = None
+        for visuals in self.visuals:
+            for visual in visuals.values():
+                visual.parent = None
 
-        self.vpview = self.canvas.central_widget.add_view(bgcolor='white')
-        # vispy.scene.visuals.XYZAxis(parent=self.vpview.scene)
+        self.visuals = []
+        self.meshes = []
+        self.data = []
+        self.visible = set()
+        self.bvh = None
 
     def plot(self, types="solid + wireframe"):
-        self.clear()
+        '''Show the model meshes as types ("solid", "wireframe")
+
+        The view, camera and visuals persist between calls. A visual is
+        created once per mesh and type, its data replaced with set_data
+        when the displayed mesh changes, and otherwise only shown or hidden.
+        '''
         if isinstance(types, (str,)):
             types = [s.strip() for s in types.split('+')]
-
-        for mesh in self.model.data:
+        if any(type not in ("solid", "wireframe") for type in types):
+            # Unknown plot type
+            return None
+        self.types = types
+
+        if self.vpview is None:
+            self.vpview = self.canvas.central_widget.add_view(bgcolor='white')
+            # vispy.scene.visuals.XYZAxis(parent=self.vpview.scene)
+            self.vpview.camera = vispy.scene.TurntableCamera(parent=self.vpview.scene)
+            self.vpview.scene.transform.changed.connect(self.cull)
+
+        meshes = self.get_meshes()
+        for visuals in self.visuals[len(meshes):]:
+            for visual in visuals.values():
+                visual.parent = None
+        del self.visuals[len(meshes):]
+
+        for i, mesh in enumerate(meshes):
+            if i == len(self.visuals):
+                self.visuals.append({})
+            visuals = self.visuals[i]
+            if i < len(self.meshes) and self.meshes[i] is not mesh:
+                # Reuse the visuals of the shown types for the new mesh data.
+                for type in list(visuals):
+                    if type in types:
+                        self.set_visual_data(visuals[type], type, mesh)
+                    else:
+                        visuals.pop(type).parent = None
             for type in types:
+                if type not in visuals:
+                    visuals[type] = self.get_visual(type, mesh)
+                    self.vpview.add(visuals[type])
+        self.meshes = meshes
+
+        if self.data != self.model.data:
+            self.data = list(self.model.data)
+            self.bvh = BoundingVolumeHierarchy(self.model.get_bounds())
+            self.visible = set(range(len(self.data)))
+            if self.data:
+                self.vpview.camera.set_range()
+
+        self.update_visibility()
+
+    def get_visual(self, type, mesh):
+        if type=="solid":
+            visual = vispy.scene.visuals.Mesh(shading='smooth')
+        else:
+            visual = vispy.scene.visuals.Line()
+        self.set_visual_data(visual, type, mesh)
+        return visual
+
+    def set_visual_data(self, visual, type, mesh):
+        if type=="solid":
+            meshdata = vispy.geometry.MeshData(vertices=mesh.vertices, faces=mesh.faces)
+            # MeshData has no normals setter, prefill its cache with
+            # the cached mesh normals instead of recomputing them.
+            meshdata._vertex_normals = mesh.get_vertex_normals()
+            visual.set_data(meshdata=meshdata)
+        else:
+            # Mesh vertices with an index buffer of the unique edges, instead
+            # of two duplicated end points per edge.
+            visual.set_data(pos=mesh.vertices, connect=mesh.get_edges())
 
-                if type=="solid":
-                    msh = vispy.scene.visuals.Mesh(vertices=mesh.vertices, \
-                                                   shading='smooth', faces=mesh.faces)
-                    self.vpview.add(msh)
-
-                elif type=="wireframe":
-                    n_faces = len(mesh.faces)
-                    ix = np.tile([0, 1, 1, 2, 2, 0], n_faces) + \
-                        np.repeat(np.arange(0, 3*n_faces, 3), 6)
-                    edges = mesh.faces.reshape(-1)[ix]
-                    edg = vispy.scene.visuals.Line(pos=mesh.vertices[edges], connect="segments")
-                    self.vpview.add(edg)
+    def update_visibility(self):
+        for i, visuals in enumerate(self.visuals):
+            for type, visual in visuals.items():
+                visual.visible = i in self.visible and type in self.types
 
-                else:
-                    # Unknown plot type
-                    return None
+    def cull(self, event=None):
+        '''Hide meshes outside the view or smaller than min_pixels
 
-        self.vpview.camera = vispy.scene.TurntableCamera(parent=self.vpview.scene)
+        Called on camera changes. The mesh bounding boxes are queried
+        through a bounding volume hierarchy, and visuals only updated if
+        the visible set changed.
+        '''
+        if self.bvh is None:
+            return
+
+        tr = self.vpview.scene.node_transform(self.canvas.scene)
+        width, height = self.canvas.size
+
+        def is_visible(lo, hi):
+            corners = np.stack(np.meshgrid(*zip(lo, hi), indexing='ij'), -1).reshape(-1, 3)
+            p = tr.map(corners)
+            if (p[:,3] <= 0).any():
+                return True  # Crosses the camera plane.
+            p = p[:,:2]/p[:,3:]
+            if (p.max(0) < 0).any() or p[:,0].min() > width or p[:,1].min() > height:
+                return False
+            return (p.max(0) - p.min(0)).max() >= self.min_pixels
+
+        visible = set(self.bvh.query(is_visible))
+        if visible != self.visible:
+            self.visible = visible
+            self.update_visibility()
+
+    def get_meshes(self):
+        '''Model meshes at the level of detail to display'''
+        return self.model.get_meshes(None if self.full_resolution else self.max_faces)
 
     def xy(self):
         self.vpview.camera.elevation = 90
@@ -176,7 +213,8 @@ class View():
     def reset(self):
         self.vpview.camera.reset()
 
-class Controller():
+
+class Controller(LoaderController):
 
     def __init__(self, view=None):
 
@@ -205,10 +243,25 @@ class Controller():
         o1.pack()
         toolbar.append(f2)
 
+        full = tk.BooleanVar()
+        toolbar.append(tk.Checkbutton(f1, text="Full detail", variable=full,
+                                      command=lambda: self.set_full_resolution(full.get(), var)))
+
         toolbar[0].config(command=lambda: self.open(var))
 
         [obj.pack(side=tk.LEFT, anchor=tk.W) for obj in toolbar]
 
+        f4 = ttk.Frame(f1)
+        progressbar = ttk.Progressbar(f4, length=100, maximum=1.0)
+        progressbar.pack(side=tk.LEFT, padx=4)
+        status = tk.Label(f4)
+        status.pack(side=tk.LEFT)
+        tk.Button(f4, text="Cancel", command=self.cancel).pack(side=tk.LEFT)
+        self.status_frame = f4
+        self.progressbar = progressbar
+        self.status = status
+        self.loader = None
+
         canvas = vispy.scene.SceneCanvas(
             keys='interactive', show=True, parent=root)
         canvas.native.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
@@ -227,18 +280,8 @@ class Controller():
         self.model = view.model
         view.plot()
 
-    def render(self):
-        self.root.mainloop()
-
-    def open(self, var):
-        file_name = askopenfilename( title = "Select file to open",
-                                     filetypes = (("CAD files","*.obj;*.stl"),
-                                                  ("all files","*.*")) )
-        self.model.clear()
-        self.model.load_file(file_name)
-        self.view.plot(var.get())
-
     def exit(self):
+        self.cancel()
         self.model.clear()
         self.view.clear()
         self.root.destroy()
@@ -259,12 +302,10 @@ def setMaxWidth(stringList, element):
 class App():
 
     def __init__(self, model=None, view=None, controller=None):
-        file_name = None
-        if len(sys.argv) >= 2:
-            file_name = sys.argv[1]
+        args = parse_args()
 
         if model is None:
-            model = Model(file_name)
+            model = Model(args.files or None, mmap=args.mmap, weld=args.weld, cache=MeshCache())
 
         if view is None:
             view = View(model)
@@ -282,5 +323,6 @@ class App():
 
 if __name__ == "__main__":
 
+    multiprocessing.freeze_support()
     app = App()
     app.start()
@@ -0,0 +1,390 @@
+"""Benchmarks of the Mesh Viewer loaders, geometry operations and plot
+data preparation on synthetic sphere and torus meshes.
+
+    python test/benchmark.py [-o results.json] [--sizes 1e3,1e4,1e5,1e6]
+                             [--shapes sphere,torus] [--modules core,mpl,plotly]
+                             [--repeat 3] [--data-dir DIR]
+
+    python test/benchmark.py --compare old.json new.json
+
+The import time of every backend module (python -X importtime in a
+fresh interpreter) is recorded as well, with its slowest packages.
+Each stage is timed (best of --repeat runs) and its peak memory
+recorded with tracemalloc in a separate run. Meshes of up to 1e7
+triangles can be generated, the ASCII STL and OBJ files are then
+several GB. The loaders and geometry operations are timed once on the
+shared meshviewer_core module, the plot data preparation per backend,
+and the matplotlib frame time (Agg canvas draws of the full and a
+zoomed in view, with and without chunked collections).
+Backend modules which can not be imported (for example without
+cefpython3 or vispy installed) are skipped.
+
+:license: AGPL v3, see LICENSE for more details or contact
+          Precise Simulation for alternative licensing options.
+:copyright: 2020 Precise Simulation Ltd.
+
+"""
+
+import argparse
+import gc
+import importlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root_dir)
+
+import meshviewer_core
+from meshviewer_core import Model, Mesh, stl_binary_dtype
+
+backend_modules = {"core": "meshviewer_core",
+                   "mpl": "meshviewer_mpl_tk",
+                   "plotly": "meshviewer_plotly_cef_tk",
+                   "vispy": "meshviewer_vispy_tk"}
+
+
+def make_mesh(shape, n_triangles):
+    '''Triangulated sphere or torus with about n_triangles triangles
+    '''
+    # Grid of n_u x n_v quads, two triangles each, periodic in u.
+    n_v = max(int(round(np.sqrt(n_triangles/4))), 2)
+    n_u = 2*n_v
+    u = np.linspace(0, 2*np.pi, n_u, endpoint=False)
+    if shape == "sphere":
+        # Rings from pole to pole (with degenerate triangles at the poles).
+        n_rows = n_v + 1
+        v = np.linspace(0, np.pi, n_rows)
+        u, v = np.meshgrid(u, v, indexing='ij')
+        x = np.sin(v)*np.cos(u)
+        y = np.sin(v)*np.sin(u)
+        z = np.cos(v)
+    elif shape == "torus":
+        n_rows = n_v
+        v = np.linspace(0, 2*np.pi, n_rows, endpoint=False)
+        u, v = np.meshgrid(u, v, indexing='ij')
+        r = 1 + 0.25*np.cos(v)
+        x = r*np.cos(u)
+        y = r*np.sin(u)
+        z = 0.25*np.sin(v)
+    else:
+        raise ValueError("Unknown shape " + shape)
+
+    vertices = np.stack([x, y, z], axis=-1).reshape(-1, 3).astype(np.float32)
+
+    i, j = np.meshgrid(np.arange(n_u), np.arange(n_v), indexing='ij')
+    i1 = (i + 1) % n_u
+    j1 = (j + 1) % n_rows
+    p00 = i*n_rows + j
+    p10 = i1*n_rows + j
+    p01 = i*n_rows + j1
+    p11 = i1*n_rows + j1
+    faces = np.concatenate([np.stack([p00, p10, p11], axis=-1).reshape(-1, 3),
+                            np.stack([p00, p11, p01], axis=-1).reshape(-1, 3)])
+
+    return vertices, faces.astype(np.uint32)
+
+
+def write_formatted(f, template, values, chunk_size=2**16):
+    '''Write rows of values formatted with a per row template string
+    '''
+    for i in range(0, len(values), chunk_size):
+        chunk = values[i:i+chunk_size]
+        f.write((template*len(chunk)) % tuple(chunk.ravel().tolist()))
+
+
+def write_stl_ascii(file_name, vertices, faces):
+    normals = get_normals(vertices, faces)
+    data = np.concatenate([normals, vertices[faces].reshape(-1, 9)], axis=1)
+    template = ' facet normal %e %e %e\n  outer loop\n' + \
+               '   vertex %e %e %e\n'*3 + '  endloop\n endfacet\n'
+    with open(file_name, 'w') as f:
+        f.write('solid benchmark\n')
+        write_formatted(f, template, data)
+        f.write('endsolid benchmark\n')
+
+
+def write_stl_binary(file_name, vertices, faces):
+    data = np.zeros(len(faces), dtype=stl_binary_dtype)
+    data['normal'] = get_normals(vertices, faces)
+    data['vertices'] = vertices[faces]
+    with open(file_name, 'wb') as f:
+        f.write(b'benchmark'.ljust(80))
+        f.write(np.uint32(len(faces)).astype('<u4').tobytes())
+        data.tofile(f)
+
+
+def write_obj(file_name, vertices, faces):
+    with open(file_name, 'w') as f:
+        write_formatted(f, 'v %e %e %e\n', vertices)
+        write_formatted(f, 'f %d %d %d\n', faces.astype(np.int64) + 1)
+
+
+def write_obj_comments(file_name, vertices, faces):
+    with open(file_name, 'w') as f:
+        f.write('# benchmark\n')
+        write_formatted(f, 'v %e %e %e # vertex\n', vertices)
+        write_formatted(f, 'f %d %d %d # face\n', faces.astype(np.int64) + 1)
+
+
+def get_normals(vertices, faces):
+    p = vertices[faces]
+    n = np.cross(p[:,1] - p[:,0], p[:,2] - p[:,0])
+    l = np.linalg.norm(n, axis=1, keepdims=True)
+    return n/np.where(l > 0, l, 1)
+
+
+mesh_writers = {"stl_ascii": (".stl", write_stl_ascii),
+                "stl_binary": (".stl", write_stl_binary),
+                "obj": (".obj", write_obj),
+                "obj_comments": (".obj", write_obj_comments)}
+
+
+def get_mesh_file(data_dir, shape, n_triangles, format, mesh):
+    '''Generate (or reuse) the mesh file of a given format
+    '''
+    ext, writer = mesh_writers[format]
+    file_name = os.path.join(data_dir, "%s_%d_%s%s" % (shape, n_triangles, format, ext))
+    if not os.path.exists(file_name):
+        writer(file_name + ".tmp", *mesh)
+        os.replace(file_name + ".tmp", file_name)
+
+    return file_name
+
+
+def measure(setup, run, repeat=3):
+    '''Best wall time of run(setup()) over repeat runs and its tracemalloc peak memory
+    '''
+    times = []
+    for _ in range(repeat):
+        arg = setup()
+        gc.collect()
+        t = time.perf_counter()
+        run(arg)
+        times.append(time.perf_counter() - t)
+        del arg
+
+    arg = setup()
+    gc.collect()
+    tracemalloc.start()
+    run(arg)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return min(times), peak
+
+
+def get_stages(module, mesh, files, max_draw_faces=1e6):
+    '''(stage, format, setup, run) tuples of the benchmarks available in module
+    '''
+    def new_model():
+        model = Model()
+        model.clear()
+        return model
+
+    stages = []
+    vertices, faces = mesh
+    if module is meshviewer_core:
+        for stage, method, format in [("load_stl_ascii", "load_stl_ascii", "stl_ascii"),
+                                      ("load_stl_binary", "load_stl_binary", "stl_binary"),
+                                      ("load_obj", "load_obj", "obj"),
+                                      ("load_obj_comments", "load_obj", "obj_comments")]:
+            file_name = files[format]
+            stages.append((stage, format, new_model,
+                           lambda model, method=method, file_name=file_name: getattr(model, method)(file_name)))
+
+        stages.append(("get_line_segments", None, lambda: Mesh(vertices, faces),
+                       lambda mesh: mesh.get_line_segments()))
+
+        stages.append(("get_vertex_normals", None, lambda: Mesh(vertices, faces),
+                       lambda mesh: mesh.get_vertex_normals()))
+
+        def setup():
+            model = new_model()
+            model.data.append(Mesh(vertices, faces))
+            return model
+        stages.append(("get_bounding_box", None, setup, lambda model: model.get_bounding_box()))
+
+    View = getattr(module, "View", None)
+    if module.__name__ == backend_modules["mpl"] and len(faces) <= max_draw_faces:
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        def get_draw_setup(chunked, zoomed):
+            def setup():
+                model = new_model()
+                model.data.append(Mesh(vertices, faces))
+                view = View(new_model())
+                view.proxy = None
+                view.full_resolution = True
+                if not chunked:
+                    view.chunk_faces = None
+                view.model = model
+                view.plot("solid")
+                if zoomed:
+                    # Quarter of the model in view.
+                    bbox = model.get_bounding_box()
+                    view.axes.set_xlim3d(sum(bbox[0])/2, bbox[0][1])
+                    view.axes.set_ylim3d(sum(bbox[1])/2, bbox[1][1])
+                view.canvas = FigureCanvasAgg(view.figure)
+                return view
+            return setup
+
+        for chunked in (True, False):
+            for zoomed in (False, True):
+                stage = "draw" + ("_zoomed" if zoomed else "") + ("" if chunked else "_unchunked")
+                stages.append((stage, None, get_draw_setup(chunked, zoomed), lambda view: view.update()))
+
+    if hasattr(View, "get_plotly_mesh3d_data"):
+        # Only the trace data preparation, without creating a browser view.
+        view = View.__new__(View)
+        stages.append(("get_plotly_mesh3d_data", None, lambda: Mesh(vertices, faces),
+                       lambda mesh: view.get_plotly_mesh3d_data(mesh)))
+
+    return stages
+
+
+def get_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=root_dir,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+        if subprocess.call(["git", "diff", "--quiet", "HEAD"], cwd=root_dir,
+                           stderr=subprocess.DEVNULL) != 0:
+            commit += "-dirty"
+        return commit
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_import_time(module_name, n_packages=5):
+    '''Cumulative import time of module_name in a fresh interpreter and
+    the (package, time) of its n_packages slowest top level packages
+    '''
+    p = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module_name],
+                       cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       universal_newlines=True)
+    if p.returncode != 0:
+        raise ImportError(p.stderr.strip().splitlines()[-1])
+
+    # Lines "import time: self [us] | cumulative | imported package".
+    times = {}
+    for line in p.stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if not line.startswith("import time:") or len(fields) != 3 or "[us]" in line:
+            continue
+        times[fields[2].strip()] = int(fields[1])*1e-6
+
+    packages = sorted(((name, t) for name, t in times.items() if "." not in name and name != module_name),
+                      key=lambda x: -x[1])
+    return times.get(module_name, 0.0), packages[:n_packages]
+
+
+def run_benchmarks(args):
+    import_times = []
+    for name in args.modules.split(","):
+        try:
+            t, packages = get_import_time(backend_modules[name])
+        except ImportError:
+            continue  # reported as skipped below
+        import_times.append({"module": name, "time": t, "packages": packages})
+        print("%-7s %-23s %10.4f s  %s" % (name, "import", t,
+                                           ", ".join("%s %.3f" % package for package in packages)))
+
+    modules = {}
+    for name in args.modules.split(","):
+        try:
+            modules[name] = importlib.import_module(backend_modules[name])
+        except Exception as e:
+            print("Skipping %s: %s" % (name, e), file=sys.stderr)
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    results = []
+    for shape in args.shapes.split(","):
+        for size in args.sizes.split(","):
+            mesh = make_mesh(shape, int(float(size)))
+            n_triangles = len(mesh[1])
+            files = {format: get_mesh_file(args.data_dir, shape, n_triangles, format, mesh)
+                     for format in mesh_writers}
+
+            for name, module in modules.items():
+                for stage, format, setup, run in get_stages(module, mesh, files, float(args.max_draw_faces)):
+                    t, peak = measure(setup, run, args.repeat)
+                    results.append({"module": name, "stage": stage, "shape": shape,
+                                    "format": format, "n_triangles": n_triangles,
+                                    "time": t, "peak_memory": peak})
+                    print("%-7s %-23s %-7s %9d  %10.4f s  %9.1f MB" %
+                          (name, stage, shape, n_triangles, t, peak/2**20))
+
+    return {"commit": get_commit(),
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "import_times": import_times,
+            "results": results}
+
+
+def compare(old_file, new_file):
+    '''Print the time and peak memory ratios (new/old) of two result files
+    '''
+    with open(old_file) as f:
+        old = json.load(f)
+    with open(new_file) as f:
+        new = json.load(f)
+
+    def key(r):
+        return (r["module"], r["stage"], r["shape"], r["n_triangles"])
+
+    print("%s -> %s" % (old.get("commit"), new.get("commit")))
+
+    old_import_times = {r["module"]: r for r in old.get("import_times", [])}
+    for r in new.get("import_times", []):
+        r_old = old_import_times.get(r["module"])
+        if r_old is not None and r_old["time"] > 0:
+            print("%-7s %-23s %10.4f %10.4f %6.2fx" %
+                  (r["module"], "import", r_old["time"], r["time"], r["time"]/r_old["time"]))
+
+    old_results = {key(r): r for r in old["results"]}
+    print("%-7s %-23s %-7s %9s  %10s %10s %7s  %9s" %
+          ("module", "stage", "shape", "triangles", "old [s]", "new [s]", "time", "memory"))
+    for r in new["results"]:
+        r_old = old_results.get(key(r))
+        if r_old is None:
+            continue
+        time_ratio = r["time"]/r_old["time"] if r_old["time"] > 0 else float("nan")
+        memory_ratio = r["peak_memory"]/r_old["peak_memory"] if r_old["peak_memory"] > 0 else float("nan")
+        print("%-7s %-23s %-7s %9d  %10.4f %10.4f %6.2fx  %8.2fx" %
+              (key(r) + (r_old["time"], r["time"], time_ratio, memory_ratio)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Mesh Viewer benchmarks.")
+    parser.add_argument("-o", "--output", default="benchmark.json", help="JSON results file")
+    parser.add_argument("--sizes", default="1e3,1e4,1e5,1e6", help="comma separated triangle counts")
+    parser.add_argument("--shapes", default="sphere,torus", help="comma separated shapes")
+    parser.add_argument("--modules", default="core,mpl,plotly", help="comma separated backends")
+    parser.add_argument("--max-draw-faces", default="1e6", help="largest mesh drawn in the mpl benchmarks")
+    parser.add_argument("--repeat", type=int, default=3, help="number of timed runs")
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "meshviewer-benchmark"),
+                        help="directory of the generated mesh files")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="compare two result files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    data = run_benchmarks(args)
+    with open(args.output, "w") as f:
+        json.dump(data, f, indent=1)
+
+
+if __name__ == "__main__":
+
+    main()